@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
 import boto3
+from botocore.config import Config
 import yaml
 import argparse
+import numpy as np
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
 from datetime import datetime, timedelta
 import json
+import csv
+import gzip
+import io
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib.request
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
 
 # 全局常量
+# 区域代码 -> Pricing location 的静态兜底映射，优先使用价格表自身的 regionCode 属性生成的映射
 REGION_MAP = {
     'us-east-1': 'US East (N. Virginia)',
     'us-east-2': 'US East (Ohio)',
@@ -33,15 +48,175 @@ REGION_MAP = {
 OS_MAP = {'Linux': 'Linux', 'Windows': 'Windows', 'RHEL': 'RHEL', 'SUSE': 'SUSE'}
 SPOT_OS_MAP = {'Linux': 'Linux/UNIX', 'Windows': 'Windows', 'RHEL': 'Red Hat Enterprise Linux', 'SUSE': 'SUSE Linux'}
 
+# RI 合同期/付款方式 -> (价格字段, 合同小时数)
+RI_KEY_MAP = {
+    ('1yr', 'No Upfront'): ('ri_1y_no_upfront', 8760),
+    ('1yr', 'Partial Upfront'): ('ri_1y_partial_upfront', 8760),
+    ('1yr', 'All Upfront'): ('ri_1y_all_upfront', 8760),
+    ('3yr', 'No Upfront'): ('ri_3y_no_upfront', 26280),
+    ('3yr', 'Partial Upfront'): ('ri_3y_partial_upfront', 26280),
+    ('3yr', 'All Upfront'): ('ri_3y_all_upfront', 26280)
+}
+
+# 批量价格文件（Bulk Price List），每个区域下载一次后生成本地索引
+PRICE_LIST_BASE = 'https://pricing.us-east-1.amazonaws.com'
+CN_PRICE_LIST_BASE = 'https://pricing.cn-north-1.amazonaws.com.cn'
+EC2_PRICE_CSV_URL = '{base}/offers/v1.0/aws/AmazonEC2/current/{region}/index.csv'
+SP_REGION_INDEX_URL = '{base}/savingsPlan/v1.0/aws/AWSComputeSavingsPlan/current/region_index.json'
+PRICE_INDEX_DIR = '.price_index'
+# *.metal 机型的 Product Family 为 'Compute Instance (bare metal)'
+EC2_PRODUCT_FAMILIES = ('Compute Instance', 'Compute Instance (bare metal)')
+# Savings Plan 折扣对应的 EC2 Operation -> 操作系统
+SP_OPERATION_OS = {'RunInstances': 'Linux', 'RunInstances:0002': 'Windows', 'RunInstances:0010': 'RHEL', 'RunInstances:000g': 'SUSE'}
+TENANCY_USAGE = {'BoxUsage': 'Shared', 'DedicatedUsage': 'Dedicated'}
+
+# Spot价格历史分析的默认天数，以及报告中的Spot分析列
+SPOT_HISTORY_DAYS = 7
+SPOT_FIELDS = [
+    ('spot_az', 'Spot最优AZ'), ('spot_p90', 'Spot-P90/小时'), ('spot_max', 'Spot最高/小时'),
+    ('spot_changes_per_day', 'Spot日均变价次数'), ('spot_savings', 'Spot比按需节省')
+]
+
+# 每个区域一把锁：生成某个区域的索引时不阻塞其他区域的生成和已加载区域的查询
+_price_index = {}
+_price_index_locks = defaultdict(threading.Lock)
+_price_index_locks_lock = threading.Lock()
+
+# 本地持久缓存（SQLite），所有区域和多次运行共享，各数据源有独立的过期时间（秒）
+CACHE_FILE = '.instance_select_cache.db'
+CACHE_TTL = {'instance_types': 7 * 86400, 'prices': 86400, 'spot': 3600, 'price_index': 7 * 86400, 'regions': 30 * 86400}
+_cache = {'conn': None, 'ttl': dict(CACHE_TTL), 'refresh_before': 0}
+_cache_lock = threading.Lock()
+
+# Lambda 公开价格（美元）：请求费用，以及按每月GB-秒用量阶梯计费 [(阶梯上限GB-秒, 单价)]
+LAMBDA_REQUEST_PRICE = 0.20 / 1000000
+LAMBDA_GBS_TIERS = {
+    'x86': [(6e9, 0.0000166667), (15e9, 0.0000150000), (np.inf, 0.0000133334)],
+    'arm': [(6e9, 0.0000133334), (15e9, 0.0000120001), (np.inf, 0.0000106667)]
+}
+LAMBDA_MB_PER_VCPU = 1769
+HOURS_PER_MONTH = 730
+
+# 每次运行的结果快照（Parquet），用于 --diff 对比两次运行的变化
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_KEY = ('region', 'service', 'instance_type')
+DIFF_THRESHOLD = 5
+
+# 两层并发调度：区域级线程池 × 机型级全局线程池，机型级并发受 Pricing API 限流约束
+REGION_WORKERS = 8
+PRICE_WORKERS = 10
+# adaptive 重试模式在客户端侧做限流，遇到 Throttling 自动退避
+CLIENT_CONFIG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=50)
+_clients = {}
+_clients_lock = threading.Lock()
+_price_executor = None
+_region_locations = {}
+_region_locations_lock = threading.Lock()
+
 def load_config(config_file):
     with open(config_file, 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
 
+def init_cache(cache_config=None, refresh=False):
+    """打开本地缓存，refresh为True时忽略本次运行之前写入的数据"""
+    cache_config = cache_config or {}
+    conn = sqlite3.connect(cache_config.get('file', CACHE_FILE), check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS cache (source TEXT, key TEXT, value TEXT, updated REAL, PRIMARY KEY (source, key))')
+    conn.commit()
+    _cache.update(conn=conn, ttl={**CACHE_TTL, **(cache_config.get('ttl') or {})},
+                  refresh_before=time.time() if refresh else 0)
+
+def cache_fresh(source, updated):
+    return updated >= _cache['refresh_before'] and time.time() - updated < _cache['ttl'].get(source, 0)
+
+def cache_get(source, key):
+    if _cache['conn'] is None:
+        return None
+    with _cache_lock:
+        row = _cache['conn'].execute('SELECT value, updated FROM cache WHERE source = ? AND key = ?', (source, key)).fetchone()
+    if row and cache_fresh(source, row[1]):
+        return json.loads(row[0])
+    return None
+
+def cache_put(source, key, value):
+    if _cache['conn'] is None:
+        return
+    with _cache_lock:
+        _cache['conn'].execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                               (source, key, json.dumps(value, default=str), time.time()))
+        _cache['conn'].commit()
+
+def get_client(service, region):
+    """按服务/区域复用boto3客户端，客户端线程安全，但创建过程需要加锁"""
+    with _clients_lock:
+        if (service, region) not in _clients:
+            _clients[(service, region)] = boto3.client(service, region_name=region, config=CLIENT_CONFIG)
+        return _clients[(service, region)]
+
+def get_price_executor(workers=PRICE_WORKERS):
+    """所有区域共用的机型级价格查询线程池，控制全局并发"""
+    global _price_executor
+    with _clients_lock:
+        if _price_executor is None:
+            _price_executor = ThreadPoolExecutor(max_workers=workers)
+        return _price_executor
+
+def pricing_region(region):
+    """Pricing API 所在区域，中国区价格在 cn-northwest-1 查询"""
+    return 'cn-northwest-1' if region.startswith('cn-') else 'us-east-1'
+
+def price_list_base(region):
+    return CN_PRICE_LIST_BASE if region.startswith('cn-') else PRICE_LIST_BASE
+
+def fetch_region_locations(pricing_region_name):
+    """从价格表的 regionCode 属性获取所有区域（含Local Zone），再查询每个区域对应的 location 名称"""
+    client = get_client('pricing', pricing_region_name)
+    try:
+        codes = []
+        for page in client.get_paginator('get_attribute_values').paginate(ServiceCode='AmazonEC2', AttributeName='regionCode'):
+            codes.extend(v['Value'] for v in page['AttributeValues'])
+        
+        def location_of(code):
+            response = client.get_products(
+                ServiceCode='AmazonEC2',
+                Filters=[{'Type': 'TERM_MATCH', 'Field': 'regionCode', 'Value': code}],
+                MaxResults=1
+            )
+            if response['PriceList']:
+                return json.loads(response['PriceList'][0])['product']['attributes'].get('location')
+            return None
+        
+        with ThreadPoolExecutor(max_workers=PRICE_WORKERS) as executor:
+            return {code: location for code, location in zip(codes, executor.map(location_of, codes)) if location}
+    except Exception as e:
+        print(f"  Warning: Region metadata query failed: {e}")
+        return {}
+
+def get_region_locations(region):
+    """区域所在分区的 regionCode -> location 映射，本地缓存，同一分区只查询一次"""
+    key = pricing_region(region)
+    with _region_locations_lock:
+        if key not in _region_locations:
+            _region_locations[key] = cached('regions', key, lambda: fetch_region_locations(key)) or {}
+        return _region_locations[key]
+
+def get_location(region):
+    return get_region_locations(region).get(region) or REGION_MAP.get(region, region)
+
+def cached(source, key, fetch):
+    """先查本地缓存，未命中或过期时调用fetch获取并写回，空结果不缓存"""
+    value = cache_get(source, key)
+    if value is None:
+        value = fetch()
+        if value:
+            cache_put(source, key, value)
+    return value
+
 def get_lightsail_instances(region, config):
-    client = boto3.client('lightsail', region_name=region)
+    client = get_client('lightsail', region)
     results = []
     try:
-        bundles = client.get_bundles()['bundles']
+        bundles = cached('instance_types', f'lightsail|{region}', lambda: client.get_bundles()['bundles'])
         os_config = config.get('operating_system', 'Linux')
         os_platform = 'WINDOWS' if os_config == 'Windows' else 'LINUX_UNIX'
         
@@ -60,7 +235,7 @@ def get_lightsail_instances(region, config):
             price = bundle.get('price', 0)
             result = {
                 'service': 'Lightsail', 'region': region, 'instance_type': bundle['bundleId'],
-                'cpu': cpu, 'memory_gb': memory, 'storage_gb': storage,
+                'cpu': cpu, 'memory_gb': memory, 'storage_gb': storage, 'architecture': 'x86_64',
                 'network_gbps': f"{bundle.get('transferPerMonthInGb', 0)}GB/月",
                 'ondemand': price / 730
             }
@@ -75,16 +250,14 @@ def check_range(value, min_val, max_val):
     return (min_val is None or value >= min_val) and (max_val is None or value <= max_val)
 
 def get_ec2_instances(region, config):
-    client = boto3.client('ec2', region_name=region)
+    client = get_client('ec2', region)
     results = []
     
     try:
         instance_types = fetch_instance_types(client, config)
         
-        # 批量获取价格
-        pricing_cache = {}
+        candidates = []
         for inst in instance_types:
-            instance_type = inst['InstanceType']
             cpu, memory = inst['VCpuInfo']['DefaultVCpus'], inst['MemoryInfo']['SizeInMiB'] / 1024
             
             if not (check_range(cpu, config.get('cpu_min'), config.get('cpu_max')) and
@@ -94,19 +267,36 @@ def get_ec2_instances(region, config):
             if not check_architecture(inst, config):
                 continue
             
-            # 使用缓存的价格数据
-            cache_key = (instance_type, region, config.get('operating_system', 'Linux'))
-            if cache_key not in pricing_cache:
-                pricing_cache[cache_key] = get_ec2_prices(instance_type, region, config.get('operating_system', 'Linux'), 
-                                                          config.get('pricing_types', {'ondemand': True}))
-            
+            if not check_storage_network(parse_instance_specs(inst), config):
+                continue
+            candidates.append(inst)
+        
+        # 价格表中没有的区域（新区域等）不再逐个机型查询价格，只查询Spot
+        pricing_types = config.get('pricing_types', {'ondemand': True})
+        region_locations = get_region_locations(region)
+        if region_locations and region not in region_locations:
+            print(f"  Warning: 价格表中没有区域 {region}，跳过按需/RI/SP价格查询")
+            pricing_types = {'spot': pricing_types.get('spot', False)}
+        
+        # 机型级价格查询提交到全局线程池并发执行
+        executor = get_price_executor()
+        futures = [executor.submit(get_ec2_prices, inst['InstanceType'], region, config.get('operating_system', 'Linux'),
+                                   pricing_types, config.get('pricing_source', 'api'),
+                                   config.get('spot_history_days', SPOT_HISTORY_DAYS))
+                   for inst in candidates]
+        
+        for inst, future in zip(candidates, futures):
+            instance_type = inst['InstanceType']
+            cpu, memory = inst['VCpuInfo']['DefaultVCpus'], inst['MemoryInfo']['SizeInMiB'] / 1024
             result = {
                 'service': 'EC2', 'region': region, 'instance_type': instance_type,
                 'cpu': cpu, 'memory_gb': memory,
+                'architecture': ','.join(inst['ProcessorInfo'].get('SupportedArchitectures', [])),
                 'storage_gb': inst.get('InstanceStorageInfo', {}).get('TotalSizeInGB', 0),
                 'network_gbps': inst.get('NetworkInfo', {}).get('NetworkPerformance', 'N/A')
             }
-            result.update(pricing_cache[cache_key])
+            result.update(parse_instance_specs(inst))
+            result.update(future.result())
             
             if config.get('public_ip'):
                 network_info = inst.get('NetworkInfo', {})
@@ -118,41 +308,92 @@ def get_ec2_instances(region, config):
     
     return results
 
+def describe_instance_types(client, prefix=None):
+    params = {'Filters': [{'Name': 'instance-type', 'Values': [f'{prefix}*']}]} if prefix else {}
+    instance_types = []
+    for page in client.get_paginator('describe_instance_types').paginate(**params):
+        instance_types.extend(page['InstanceTypes'])
+    return instance_types
+
 def fetch_instance_types(client, config):
+    # 缓存未过滤的原始机型数据，后缀过滤条件变化时无需重新查询
+    region = client.meta.region_name
     instance_types = []
-    if config.get('instance_type_prefix'):
-        for prefix in config['instance_type_prefix']:
-            paginator = client.get_paginator('describe_instance_types')
-            for page in paginator.paginate(Filters=[{'Name': 'instance-type', 'Values': [f'{prefix}*']}]):
-                instance_types.extend([inst for inst in page['InstanceTypes'] if check_postfix(inst['InstanceType'], config)])
-    else:
-        paginator = client.get_paginator('describe_instance_types')
-        for page in paginator.paginate():
-            instance_types.extend([inst for inst in page['InstanceTypes'] if check_postfix(inst['InstanceType'], config)])
+    for prefix in config.get('instance_type_prefix') or [None]:
+        raw = cached('instance_types', f"ec2|{region}|{prefix or '*'}", lambda: describe_instance_types(client, prefix))
+        instance_types.extend([inst for inst in raw if check_postfix(inst['InstanceType'], config)])
     return instance_types
 
-def check_postfix(instance_type, config):
-    postfix_config = config.get('instance_type_postfix')
-    if not postfix_config:
-        return True
-    
+BASIC_SUFFIXES = ['', 'i', 'a', 'g', 'i-flex', 'a-flex', 'g-flex']
+
+def parse_instance_family(instance_type):
+    """拆分机型名称，返回 (是否基本型, 增强型后缀)，无法解析时返回None"""
     parts = instance_type.split('.')
     if len(parts) < 2:
-        return False
+        return None
     
     family = parts[0]
     base_family = ''.join(c for i, c in enumerate(family) if not c.isdigit() or i == 0 or not family[i-1].isdigit())
     generation = int(''.join(c for c in family if c.isdigit()) or '0')
     suffix = family[len(base_family):]
     
+    family_prefix = ''.join(c for c in base_family if c.isalpha())
+    is_basic = suffix in BASIC_SUFFIXES and (generation >= 5 or family_prefix.startswith('t'))
+    enhanced_suffix = suffix.replace('i', '').replace('a', '').replace('g', '').replace('-flex', '')
+    return is_basic, enhanced_suffix
+
+def check_postfix(instance_type, config):
+    postfix_config = config.get('instance_type_postfix')
+    if not postfix_config:
+        return True
+    
+    parsed = parse_instance_family(instance_type)
+    if parsed is None:
+        return False
+    
+    is_basic, enhanced_suffix = parsed
     if postfix_config == '-':
-        if suffix not in ['', 'i', 'a', 'g', 'i-flex', 'a-flex', 'g-flex']:
-            return False
-        family_prefix = ''.join(c for c in base_family if c.isalpha())
-        return generation >= 5 or family_prefix.startswith('t')
+        return is_basic
     else:
-        enhanced_suffix = suffix.replace('i', '').replace('a', '').replace('g', '').replace('-flex', '')
-        return enhanced_suffix and any(s in enhanced_suffix for s in postfix_config)
+        return bool(enhanced_suffix) and any(s in enhanced_suffix for s in postfix_config)
+
+# 存储和网络数值字段及报告列名
+SPEC_FIELDS = [
+    ('ebs_baseline_iops', 'EBS基准IOPS'), ('ebs_max_iops', 'EBS最大IOPS'),
+    ('ebs_baseline_mbps', 'EBS基准吞吐(MB/s)'), ('ebs_max_mbps', 'EBS最大吞吐(MB/s)'),
+    ('network_baseline_gbps', '基准带宽(Gbps)'), ('network_peak_gbps', '峰值带宽(Gbps)'),
+    ('network_cards', '网卡数'), ('ena_support', 'ENA'),
+    ('nvme_disk_count', '本地NVMe盘数'), ('nvme_total_gb', '本地NVMe总容量(GB)')
+]
+
+def parse_instance_specs(inst):
+    """把 EbsInfo / NetworkInfo / InstanceStorageInfo 解析为数值字段"""
+    ebs = inst.get('EbsInfo', {}).get('EbsOptimizedInfo', {})
+    network_info = inst.get('NetworkInfo', {})
+    cards = network_info.get('NetworkCards', [])
+    storage_info = inst.get('InstanceStorageInfo', {})
+    nvme_disks = [d for d in storage_info.get('Disks', []) if d.get('Type') == 'ssd'] if storage_info.get('NvmeSupport') in ('required', 'supported') else []
+    return {
+        'ebs_baseline_iops': ebs.get('BaselineIops', 0),
+        'ebs_max_iops': ebs.get('MaximumIops', 0),
+        'ebs_baseline_mbps': ebs.get('BaselineThroughputInMBps', 0),
+        'ebs_max_mbps': ebs.get('MaximumThroughputInMBps', 0),
+        'network_baseline_gbps': sum(c.get('BaselineBandwidthInGbps', 0) for c in cards),
+        'network_peak_gbps': sum(c.get('PeakBandwidthInGbps', 0) for c in cards),
+        'network_cards': network_info.get('MaximumNetworkCards', len(cards)),
+        'ena_support': network_info.get('EnaSupport', 'unsupported'),
+        'nvme_disk_count': sum(d.get('Count', 1) for d in nvme_disks),
+        'nvme_total_gb': sum(d.get('Count', 1) * d.get('SizeInGB', 0) for d in nvme_disks)
+    }
+
+def check_storage_network(specs, config):
+    """按基准（持续）性能过滤存储IOPS/吞吐和网络带宽，PPS没有API数据，不参与过滤"""
+    storage_config = config.get('storage') or {}
+    network_config = config.get('network') or {}
+    return (check_range(specs['ebs_baseline_iops'], storage_config.get('iops_min'), storage_config.get('iops_max')) and
+            check_range(specs['ebs_baseline_mbps'], storage_config.get('throughput_min'), storage_config.get('throughput_max')) and
+            check_range(specs['nvme_total_gb'], storage_config.get('nvme_min'), storage_config.get('nvme_max')) and
+            check_range(specs['network_baseline_gbps'], network_config.get('bandwidth_min'), network_config.get('bandwidth_max')))
 
 def check_architecture(inst, config):
     if not config.get('architecture'):
@@ -169,23 +410,149 @@ def check_architecture(inst, config):
             return True
     return False
 
-def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_types=None):
+def iter_price_csv(url):
+    """流式读取价格CSV，跳过文件头部的元数据行，逐行返回dict"""
+    with urllib.request.urlopen(url) as resp:
+        reader = csv.reader(io.TextIOWrapper(resp, encoding='utf-8'))
+        header = None
+        for row in reader:
+            if header is None:
+                if row and row[0] == 'SKU':
+                    header = row
+                continue
+            yield dict(zip(header, row))
+
+def build_ec2_price_entries(region, index):
+    """解析区域的EC2价格文件，填充按需和RI价格"""
+    ri_parts = {}
+    for row in iter_price_csv(EC2_PRICE_CSV_URL.format(base=price_list_base(region), region=region)):
+        if (row.get('Product Family') not in EC2_PRODUCT_FAMILIES or row.get('CapacityStatus') != 'Used' or
+                row.get('Pre Installed S/W') != 'NA' or row.get('License Model') == 'Bring your own license'):
+            continue
+        key = (region, row['Instance Type'], row['Operating System'], row['Tenancy'])
+        price = float(row['PricePerUnit'] or 0)
+        if row['TermType'] == 'OnDemand':
+            if row['Unit'] == 'Hrs':
+                index.setdefault(key, {})['ondemand'] = price
+        elif row['TermType'] == 'Reserved' and row.get('OfferingClass') == 'standard':
+            key_info = RI_KEY_MAP.get((row['LeaseContractLength'], row['PurchaseOption']))
+            if key_info:
+                part = ri_parts.setdefault((key, key_info), [0, 0])
+                if row['Unit'] == 'Hrs':
+                    part[0] = price
+                elif row['Unit'] == 'Quantity':
+                    part[1] = price
+    for (key, (ri_key, hours)), (hourly_price, upfront_price) in ri_parts.items():
+        index.setdefault(key, {})[ri_key] = hourly_price + (upfront_price / hours)
+
+def build_sp_price_entries(region, index):
+    """解析区域的Savings Plan价格文件，填充 Compute/Instance SP（No Upfront）价格"""
+    with urllib.request.urlopen(SP_REGION_INDEX_URL.format(base=price_list_base(region))) as resp:
+        region_index = json.load(resp)
+    version_url = next((r['versionUrl'] for r in region_index.get('regions', []) if r.get('regionCode') == region), None)
+    if not version_url:
+        return
+    for row in iter_price_csv(price_list_base(region) + version_url.replace('.json', '.csv')):
+        if row.get('DiscountedServiceCode') != 'AmazonEC2':
+            continue
+        os_value = SP_OPERATION_OS.get(row.get('DiscountedOperation'))
+        usage, _, instance_type = row.get('DiscountedUsageType', '').rpartition(':')
+        tenancy = TENANCY_USAGE.get(usage.rpartition('-')[2])
+        if not os_value or not tenancy:
+            continue
+        usage_type = row.get('UsageType', '')
+        for duration in ('1yr', '3yr'):
+            if usage_type.endswith(f'{duration}NoUpfront'):
+                sp_type = 'compute' if usage_type.startswith('ComputeSP:') else 'instance'
+                sp_key = f"sp_{sp_type}_{duration[0]}y"
+                index.setdefault((region, instance_type, os_value, tenancy), {})[sp_key] = float(row['DiscountedRate'] or 0)
+
+def price_index_file(region, index_dir=PRICE_INDEX_DIR):
+    return os.path.join(index_dir, f'{region}.json.gz')
+
+def build_price_index(region, index_dir=PRICE_INDEX_DIR):
+    """下载区域的批量价格文件，生成 (region, instanceType, os, tenancy) 为键的本地索引"""
+    print(f"  - 下载批量价格文件生成索引: {region}")
+    index = {}
+    build_ec2_price_entries(region, index)
+    try:
+        build_sp_price_entries(region, index)
+    except Exception as e:
+        print(f"  Warning: Savings Plans price list failed for {region}: {e}")
+    os.makedirs(index_dir, exist_ok=True)
+    with gzip.open(price_index_file(region, index_dir), 'wt', encoding='utf-8') as f:
+        json.dump({'|'.join(key): prices for key, prices in index.items()}, f, separators=(',', ':'))
+    return index
+
+def load_price_index(region, index_dir=PRICE_INDEX_DIR):
+    """加载区域价格索引到内存，本地没有时先生成"""
+    index = _price_index.get(region)
+    if index is not None:
+        return index
+    with _price_index_locks_lock:
+        region_lock = _price_index_locks[region]
+    with region_lock:
+        if region not in _price_index:
+            path = price_index_file(region, index_dir)
+            if os.path.exists(path) and cache_fresh('price_index', os.path.getmtime(path)):
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    _price_index[region] = {tuple(key.split('|')): prices for key, prices in json.load(f).items()}
+            else:
+                _price_index[region] = build_price_index(region, index_dir)
+        return _price_index[region]
+
+def lookup_price_index(instance_type, region, operating_system='Linux', pricing_types=None, tenancy='Shared'):
+    """从本地价格索引查询价格，索引中没有该机型时返回None"""
+    entry = load_price_index(region).get((region, instance_type, OS_MAP.get(operating_system, 'Linux'), tenancy))
+    if entry is None:
+        return None
+    return {key: value for key, value in entry.items() if pricing_types.get(key)}
+
+def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_types=None, pricing_source='api',
+                   spot_days=SPOT_HISTORY_DAYS):
     if pricing_types is None:
         pricing_types = {'ondemand': True}
     prices = {}
-    
+
+    # 按需/RI/SP 与 Spot 分别缓存，Spot 变化快，过期时间更短
+    enabled = ','.join(sorted(k for k, v in pricing_types.items() if v and k != 'spot'))
+    if enabled:
+        prices.update(cached('prices', f'{region}|{instance_type}|{operating_system}|{pricing_source}|{enabled}',
+                             lambda: fetch_ec2_list_prices(instance_type, region, operating_system, pricing_types, pricing_source)))
+    if pricing_types.get('spot'):
+        history = cached('spot', f'{region}|{instance_type}|{operating_system}|{spot_days}',
+                         lambda: fetch_spot_history(instance_type, region, operating_system, spot_days))
+        spot = analyze_spot_history(history, spot_days)
+        if spot:
+            prices.update(spot)
+            if prices.get('ondemand'):
+                prices['spot_savings'] = 1 - spot['spot'] / prices['ondemand']
+    return prices
+
+def fetch_ec2_list_prices(instance_type, region, operating_system, pricing_types, pricing_source='api'):
+    prices = {}
+
     os_value = OS_MAP.get(operating_system, 'Linux')
-    location = REGION_MAP.get(region, region)
-    
+
+    # 使用批量价格索引时，按需/RI/SP 都直接查本地字典
+    indexed = None
+    if pricing_source == 'bulk':
+        try:
+            indexed = lookup_price_index(instance_type, region, operating_system, pricing_types)
+        except Exception as e:
+            print(f"  Warning: Price index failed for {region}: {e}")
+    if indexed is not None:
+        prices.update(indexed)
+
     # 获取按需和RI价格
-    if pricing_types.get('ondemand') or any(k.startswith('ri_') for k in pricing_types.keys()):
+    if indexed is None and (pricing_types.get('ondemand') or any(k.startswith('ri_') for k in pricing_types.keys())):
         try:
-            pricing_client = boto3.client('pricing', region_name='us-east-1')
+            pricing_client = get_client('pricing', pricing_region(region))
             response = pricing_client.get_products(
                 ServiceCode='AmazonEC2',
                 Filters=[
                     {'Type': 'TERM_MATCH', 'Field': 'instanceType', 'Value': instance_type},
-                    {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': location},
+                    {'Type': 'TERM_MATCH', 'Field': 'regionCode', 'Value': region},
                     {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': os_value},
                     {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
                     {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'Used'},
@@ -203,18 +570,10 @@ def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_type
                     prices['ondemand'] = float(price_dim['pricePerUnit']['USD'])
                 
                 if 'Reserved' in price_data['terms']:
-                    key_map = {
-                        ('1yr', 'No Upfront'): ('ri_1y_no_upfront', 8760), 
-                        ('1yr', 'Partial Upfront'): ('ri_1y_partial_upfront', 8760),
-                        ('1yr', 'All Upfront'): ('ri_1y_all_upfront', 8760), 
-                        ('3yr', 'No Upfront'): ('ri_3y_no_upfront', 26280),
-                        ('3yr', 'Partial Upfront'): ('ri_3y_partial_upfront', 26280), 
-                        ('3yr', 'All Upfront'): ('ri_3y_all_upfront', 26280)
-                    }
                     for term_val in price_data['terms']['Reserved'].values():
                         attrs = term_val['termAttributes']
                         if attrs['OfferingClass'] == 'standard':
-                            key_info = key_map.get((attrs['LeaseContractLength'], attrs['PurchaseOption']))
+                            key_info = RI_KEY_MAP.get((attrs['LeaseContractLength'], attrs['PurchaseOption']))
                             if key_info and pricing_types.get(key_info[0]):
                                 hourly_price = 0
                                 upfront_price = 0
@@ -228,9 +587,9 @@ def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_type
             print(f"  Warning: Pricing API failed for {instance_type}: {e}")
     
     # Savings Plan价格 - 使用Pricing API
-    if any(k.startswith('sp_') for k in pricing_types.keys()):
+    if indexed is None and any(k.startswith('sp_') for k in pricing_types.keys()):
         try:
-            pricing_client = boto3.client('pricing', region_name='us-east-1')
+            pricing_client = get_client('pricing', pricing_region(region))
             
             # Compute Savings Plan
             for duration, sp_key in [('1yr', 'sp_compute_1y'), ('3yr', 'sp_compute_3y')]:
@@ -240,7 +599,7 @@ def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_type
                             ServiceCode='ComputeSavingsPlans',
                             Filters=[
                                 {'Type': 'TERM_MATCH', 'Field': 'instanceType', 'Value': instance_type},
-                                {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': location},
+                                {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': get_location(region)},
                                 {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'shared'},
                                 {'Type': 'TERM_MATCH', 'Field': 'LeaseContractLength', 'Value': duration}
                             ],
@@ -263,7 +622,7 @@ def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_type
                             ServiceCode='AmazonEC2',
                             Filters=[
                                 {'Type': 'TERM_MATCH', 'Field': 'instanceType', 'Value': instance_type},
-                                {'Type': 'TERM_MATCH', 'Field': 'location', 'Value': location},
+                                {'Type': 'TERM_MATCH', 'Field': 'regionCode', 'Value': region},
                                 {'Type': 'TERM_MATCH', 'Field': 'operatingSystem', 'Value': os_value},
                                 {'Type': 'TERM_MATCH', 'Field': 'tenancy', 'Value': 'Shared'},
                                 {'Type': 'TERM_MATCH', 'Field': 'capacitystatus', 'Value': 'Used'},
@@ -284,44 +643,105 @@ def get_ec2_prices(instance_type, region, operating_system='Linux', pricing_type
         except Exception as e:
             print(f"  Warning: Savings Plans pricing failed: {e}")
     
-    # Spot价格（优化：只查询最近1天，限制结果数）
-    if pricing_types.get('spot'):
-        try:
-            ec2_client = boto3.client('ec2', region_name=region)
-            spot_product = SPOT_OS_MAP.get(operating_system, 'Linux/UNIX')
-            start_time = datetime.utcnow() - timedelta(days=1)
-            
-            response = ec2_client.describe_spot_price_history(
-                InstanceTypes=[instance_type],
-                ProductDescriptions=[spot_product],
-                StartTime=start_time,
-                MaxResults=100
-            )
-            
-            if response['SpotPriceHistory']:
-                spot_prices = [float(item['SpotPrice']) for item in response['SpotPriceHistory']]
-                prices['spot'] = sum(spot_prices) / len(spot_prices)
-        except Exception as e:
-            print(f"  Warning: Spot price failed for {instance_type}: {e}")
-    
     return prices
 
+def fetch_spot_history(instance_type, region, operating_system='Linux', days=SPOT_HISTORY_DAYS):
+    """分页获取最近days天所有AZ的Spot价格变化记录，返回 [(az, 时间戳, 价格)]"""
+    history = []
+    try:
+        ec2_client = get_client('ec2', region)
+        spot_product = SPOT_OS_MAP.get(operating_system, 'Linux/UNIX')
+        start_time = datetime.utcnow() - timedelta(days=days)
+        
+        paginator = ec2_client.get_paginator('describe_spot_price_history')
+        for page in paginator.paginate(InstanceTypes=[instance_type], ProductDescriptions=[spot_product],
+                                       StartTime=start_time, PaginationConfig={'PageSize': 1000}):
+            history.extend((item['AvailabilityZone'], item['Timestamp'].timestamp(), float(item['SpotPrice']))
+                           for item in page['SpotPriceHistory'])
+    except Exception as e:
+        print(f"  Warning: Spot price failed for {instance_type}: {e}")
+    return history
+
+def weighted_quantile(values, weights, q):
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    return float(values[order][min(np.searchsorted(cumulative, q * cumulative[-1]), len(values) - 1)])
+
+def analyze_spot_history(history, days=SPOT_HISTORY_DAYS, now=None):
+    """
+    按AZ分析Spot价格历史：每条记录的价格持续到同AZ下一条记录，按持续时间加权计算P50/P90，
+    并统计最高价和日均变价次数（中断风险参考），返回P90最低的AZ
+    """
+    if not history:
+        return None
+    now = now or time.time()
+    window_start = now - days * 86400
+    azs = np.array([h[0] for h in history], dtype=str)
+    ts = np.array([h[1] for h in history], dtype=float)
+    price = np.array([h[2] for h in history], dtype=float)
+    order = np.lexsort((ts, azs))
+    azs, ts, price = azs[order], ts[order], price[order]
+
+    # 窗口开始前的记录表示窗口开始时的价格，持续时间从窗口开始算起
+    same_az_next = np.append(azs[1:] == azs[:-1], False)
+    end = np.where(same_az_next, np.append(ts[1:], now), now)
+    duration = np.clip(end - np.maximum(ts, window_start), 0, None)
+    changed = np.append(False, (azs[1:] == azs[:-1]) & (price[1:] != price[:-1]) & (ts[1:] >= window_start))
+
+    best = None
+    starts = np.flatnonzero(np.append(True, azs[1:] != azs[:-1]))
+    for s, e in zip(starts, np.append(starts[1:], len(azs))):
+        weights = duration[s:e] if duration[s:e].sum() > 0 else np.ones(e - s)
+        stats = {
+            'spot': weighted_quantile(price[s:e], weights, 0.5),
+            'spot_az': str(azs[s]),
+            'spot_p90': weighted_quantile(price[s:e], weights, 0.9),
+            'spot_max': float(price[s:e][duration[s:e] > 0].max() if (duration[s:e] > 0).any() else price[e - 1]),
+            'spot_changes_per_day': round(float(changed[s:e].sum()) / days, 2)
+        }
+        if best is None or (stats['spot_p90'], stats['spot']) < (best['spot_p90'], best['spot']):
+            best = stats
+    return best
+
+def lambda_monthly_cost(rps, duration_ms, memory_mb, arch='x86'):
+    """按负载（请求/秒，可以是数组）计算Lambda月成本：请求费 + 阶梯GB-秒费用"""
+    requests = np.asarray(rps, dtype=float) * HOURS_PER_MONTH * 3600
+    gb_seconds = requests * duration_ms / 1000 * memory_mb / 1024
+    cost = requests * LAMBDA_REQUEST_PRICE
+    lower = 0
+    for upper, price in LAMBDA_GBS_TIERS[arch]:
+        cost = cost + np.clip(gb_seconds - lower, 0, upper - lower) * price
+        lower = upper
+    return cost
+
 def get_lambda_info(region, config):
     results = []
-    memory_sizes = [128, 256, 512, 1024, 2048, 3072, 4096, 8192, 10240]
+    workload = config.get('lambda_workload')
+    if workload:
+        # 按工作负载模型计算，价格列为月成本折算的小时成本
+        memory_sizes = [workload.get('memory_mb', 1024)]
+        arch = workload.get('arch', 'x86')
+    else:
+        # 没有工作负载模型时，按持续运行1小时估算
+        memory_sizes = [128, 256, 512, 1024, 2048, 3072, 4096, 8192, 10240]
+        arch = 'x86'
     
     for memory in memory_sizes:
         memory_gb = memory / 1024
-        if not check_range(memory_gb, config.get('memory_min'), config.get('memory_max')):
+        if not workload and not check_range(memory_gb, config.get('memory_min'), config.get('memory_max')):
             continue
         
-        cpu = memory / 1769
-        price_per_ms = 0.0000166667 * memory_gb
+        cpu = memory / LAMBDA_MB_PER_VCPU
+        if workload:
+            hourly = float(lambda_monthly_cost(workload.get('requests_per_second', 1), workload.get('duration_ms', 100),
+                                               memory, arch)) / HOURS_PER_MONTH
+        else:
+            hourly = LAMBDA_GBS_TIERS[arch][0][1] * memory_gb * 3600
         
         result = {
-            'service': 'Lambda', 'region': region, 'instance_type': f'{memory}MB',
-            'cpu': round(cpu, 2), 'memory_gb': memory_gb, 'storage_gb': 512,
-            'network_gbps': 'N/A', 'ondemand': price_per_ms * 3600000
+            'service': 'Lambda', 'region': region, 'instance_type': f'{memory}MB' + (f'-{arch}' if workload else ''),
+            'cpu': round(cpu, 2), 'memory_gb': memory_gb, 'storage_gb': 512, 'architecture': 'x86_64,arm64',
+            'network_gbps': 'N/A', 'ondemand': hourly
         }
         if config.get('public_ip'):
             result['public_ip_count'] = 0
@@ -329,11 +749,73 @@ def get_lambda_info(region, config):
     
     return results
 
+def lambda_crossover(results, workload):
+    """
+    Lambda 与同区域 EC2/Lightsail 的成本交叉曲线：在负载范围内向量化计算每个负载点
+    Lambda 月成本，以及能承载该负载的最便宜机型和台数（按CPU目标利用率和并发内存估算）
+    """
+    rps = workload.get('requests_per_second', 1)
+    duration_ms = workload.get('duration_ms', 100)
+    memory_mb = workload.get('memory_mb', 1024)
+    arch = workload.get('arch', 'x86')
+    pricing = workload.get('pricing', 'ondemand')
+    utilization = workload.get('target_utilization', 0.6)
+    load_min, load_max = workload.get('load_range', [max(rps / 100, 0.01), rps * 100])
+    loads = np.unique(np.append(np.geomspace(load_min, load_max, workload.get('points', 50)), rps))
+    lambda_cost = lambda_monthly_cost(loads, duration_ms, memory_mb, arch)
+    
+    # 每 1 请求/秒 需要的 vCPU 和内存(GB)：Lambda 按内存比例分配CPU，超过1个vCPU按单线程计
+    cpu_per_rps = duration_ms / 1000 * min(memory_mb / LAMBDA_MB_PER_VCPU, 1)
+    memory_per_rps = duration_ms / 1000 * memory_mb / 1024
+    
+    rows, crossovers = [], {}
+    for region in sorted({r['region'] for r in results}):
+        candidates = [r for r in results if r['region'] == region and r['service'] in ('EC2', 'Lightsail') and r.get(pricing)]
+        if not candidates:
+            continue
+        cpu = np.array([r['cpu'] for r in candidates], dtype=float)
+        memory = np.array([r['memory_gb'] for r in candidates], dtype=float)
+        price = np.array([r[pricing] for r in candidates], dtype=float)
+        
+        # 机型 × 负载点 矩阵：所需台数取CPU和内存约束的较大值
+        count = np.maximum(np.ceil(np.outer(1 / (cpu * utilization), loads * cpu_per_rps)),
+                           np.ceil(np.outer(1 / memory, loads * memory_per_rps)))
+        count = np.maximum(count, 1)
+        cost = count * price[:, None] * HOURS_PER_MONTH
+        best = np.argmin(cost, axis=0)
+        columns = np.arange(len(loads))
+        instance_cost = cost[best, columns]
+        
+        cheaper = np.flatnonzero(instance_cost < lambda_cost)
+        crossovers[region] = float(loads[cheaper[0]]) if len(cheaper) else None
+        for i in columns:
+            rows.append({
+                'region': region, 'rps': float(loads[i]), 'lambda_monthly': float(lambda_cost[i]),
+                'instance_monthly': float(instance_cost[i]), 'instance_type': candidates[best[i]]['instance_type'],
+                'instance_service': candidates[best[i]]['service'], 'instance_count': int(count[best[i], i])
+            })
+    return rows, crossovers
+
+CROSSOVER_HEADERS = ['区域', '请求/秒', 'Lambda/月', '机型最低/月', '服务', '机型', '台数']
+
+def crossover_row(row):
+    return [row['region'], round(row['rps'], 3), row['lambda_monthly'], row['instance_monthly'],
+            row['instance_service'], row['instance_type'], row['instance_count']]
+
+def print_crossover(crossovers, workload):
+    print(f"\nLambda 与机型成本交叉点（{workload.get('memory_mb', 1024)}MB, {workload.get('duration_ms', 100)}ms, "
+          f"{workload.get('arch', 'x86')}）：")
+    for region, load in crossovers.items():
+        if load is None:
+            print(f"  {region}: 负载范围内 Lambda 始终更便宜")
+        else:
+            print(f"  {region}: 超过 {load:.2f} 请求/秒 后使用机型更便宜")
+
 @lru_cache(maxsize=32)
 def get_dto_price(region):
     try:
-        pricing_client = boto3.client('pricing', region_name='us-east-1')
-        location = REGION_MAP.get(region, region)
+        pricing_client = get_client('pricing', pricing_region(region))
+        location = get_location(region)
         
         response = pricing_client.get_products(
             ServiceCode='AWSDataTransfer',
@@ -375,12 +857,319 @@ def query_region(region, config, services):
     
     return results
 
-def generate_excel(results, output_file, config):
-    wb = Workbook()
-    wb.remove(wb.active)
-    
+def query_regions(regions, config, services, region_workers=REGION_WORKERS):
+    """并发查询多个区域，区域内的机型价格查询共用全局线程池"""
+    all_results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(len(regions), region_workers))) as executor:
+        futures = {executor.submit(query_region, region, config, services): region for region in regions}
+        for future in as_completed(futures):
+            try:
+                all_results.extend(future.result())
+            except Exception as e:
+                print(f"区域查询失败: {e}")
+    return all_results
+
+# 目录加载时不做过滤的配置项，改为查询时向量化过滤
+CATALOG_FILTER_KEYS = ('cpu_min', 'cpu_max', 'memory_min', 'memory_max', 'architecture', 'instance_type_postfix',
+                       'instance_type_prefix', 'storage', 'network')
+PRICE_KEYS = ['ondemand', 'ri_1y_no_upfront', 'ri_1y_partial_upfront', 'ri_1y_all_upfront',
+              'ri_3y_no_upfront', 'ri_3y_partial_upfront', 'ri_3y_all_upfront',
+              'sp_compute_1y', 'sp_compute_3y', 'sp_instance_1y', 'sp_instance_3y', 'spot']
+# 每单位性能的小时成本，由基准测试得分计算
+PERF_KEYS = [f'{key}_per_perf' for key in PRICE_KEYS]
+
+class InstanceCatalog:
+    """
+    机型+价格目录，一次加载后按列保存为NumPy数组，
+    check_range / check_architecture / check_postfix 等过滤条件以向量化掩码执行
+    """
+
+    def __init__(self, results):
+        self.rows = list(results)
+        rows = self.rows
+        self.service = np.array([r['service'] for r in rows], dtype=str)
+        self.region = np.array([r['region'] for r in rows], dtype=str)
+        self.instance_type = np.array([r['instance_type'] for r in rows], dtype=str)
+        self.cpu = np.array([r['cpu'] for r in rows], dtype=float)
+        self.memory_gb = np.array([r['memory_gb'] for r in rows], dtype=float)
+        self.storage_gb = np.array([r.get('storage_gb') or 0 for r in rows], dtype=float)
+        self.ebs_baseline_iops = np.array([r.get('ebs_baseline_iops', np.nan) for r in rows], dtype=float)
+        self.ebs_baseline_mbps = np.array([r.get('ebs_baseline_mbps', np.nan) for r in rows], dtype=float)
+        self.network_baseline_gbps = np.array([r.get('network_baseline_gbps', np.nan) for r in rows], dtype=float)
+        self.nvme_total_gb = np.array([r.get('nvme_total_gb', np.nan) for r in rows], dtype=float)
+        archs = [r.get('architecture', '').split(',') for r in rows]
+        self.x86 = np.array(['x86_64' in a for a in archs], dtype=bool)
+        self.arm = np.array(['arm64' in a for a in archs], dtype=bool)
+        self.mac = np.char.startswith(self.instance_type, 'mac')
+        parsed = [parse_instance_family(r['instance_type']) for r in rows]
+        self.parsed = np.array([p is not None for p in parsed], dtype=bool)
+        self.basic = np.array([p is not None and p[0] for p in parsed], dtype=bool)
+        self.enhanced_suffix = np.array([p[1] if p else '' for p in parsed], dtype=str)
+        self.perf_score = np.array([r.get('perf_score', np.nan) for r in rows], dtype=float)
+        self.prices = {key: np.array([r.get(key, np.nan) for r in rows], dtype=float) for key in PRICE_KEYS + PERF_KEYS}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def range_mask(values, min_val, max_val):
+        mask = np.ones(len(values), dtype=bool)
+        if min_val is not None:
+            mask &= values >= min_val
+        if max_val is not None:
+            mask &= values <= max_val
+        return mask
+
+    def mask(self, config):
+        """按配置文件同样的字段生成过滤掩码，机型前后缀和架构只作用于EC2"""
+        storage_config = config.get('storage') or {}
+        network_config = config.get('network') or {}
+        mask = (self.range_mask(self.cpu, config.get('cpu_min'), config.get('cpu_max')) &
+                self.range_mask(self.memory_gb, config.get('memory_min'), config.get('memory_max')))
+        lightsail = self.service == 'Lightsail'
+        mask &= ~lightsail | self.range_mask(self.storage_gb, storage_config.get('size_min'), storage_config.get('size_max'))
+        if config.get('regions'):
+            mask &= np.isin(self.region, config['regions'])
+        if config.get('services'):
+            mask &= np.isin(np.char.lower(self.service), [s.lower() for s in config['services']])
+
+        ec2 = self.service == 'EC2'
+        ec2_mask = (self.range_mask(self.ebs_baseline_iops, storage_config.get('iops_min'), storage_config.get('iops_max')) &
+                    self.range_mask(self.ebs_baseline_mbps, storage_config.get('throughput_min'), storage_config.get('throughput_max')) &
+                    self.range_mask(self.nvme_total_gb, storage_config.get('nvme_min'), storage_config.get('nvme_max')) &
+                    self.range_mask(self.network_baseline_gbps, network_config.get('bandwidth_min'), network_config.get('bandwidth_max')))
+        if config.get('instance_type_prefix'):
+            prefix_mask = np.zeros(len(self), dtype=bool)
+            for prefix in config['instance_type_prefix']:
+                prefix_mask |= np.char.startswith(self.instance_type, prefix)
+            ec2_mask &= prefix_mask
+        postfix_config = config.get('instance_type_postfix')
+        if postfix_config == '-':
+            ec2_mask &= self.basic
+        elif postfix_config:
+            postfix_mask = np.zeros(len(self), dtype=bool)
+            for s in postfix_config:
+                postfix_mask |= np.char.find(self.enhanced_suffix, s) >= 0
+            ec2_mask &= self.parsed & (self.enhanced_suffix != '') & postfix_mask
+        if config.get('architecture'):
+            arch_list = config['architecture'] if isinstance(config['architecture'], list) else [config['architecture']]
+            arch_mask = np.zeros(len(self), dtype=bool)
+            for arch in arch_list:
+                arch_mask |= {'x86': self.x86, 'arm': self.arm, 'mac': self.mac}.get(arch, False)
+            ec2_mask &= arch_mask
+        return mask & (~ec2 | ec2_mask)
+
+    def query(self, sort_by='ondemand', limit=None, **filters):
+        """按过滤条件返回结果，按指定价格（或 <价格>_per_perf 性能成本）从低到高排序，没有该值的排在最后"""
+        indexes = np.flatnonzero(self.mask(filters))
+        price = self.prices[sort_by][indexes]
+        order = indexes[np.argsort(np.where(np.isnan(price), np.inf, price), kind='stable')]
+        if limit:
+            order = order[:limit]
+        return [self.rows[i] for i in order]
+
+def load_catalog(config, services=None):
+    """
+    库模式入口：按配置加载一次全量机型和价格（忽略cpu/内存/架构/前后缀/存储/网络过滤），
+    之后可以用不同条件多次调用 catalog.query() 筛选，这些条件都在 query() 中向量化执行
+    """
+    catalog_config = {k: v for k, v in config.items() if k not in CATALOG_FILTER_KEYS}
+    regions = config.get('regions', ['us-east-1'])
+    services = services or config.get('services', ['lightsail', 'ec2', 'lambda'])
+    return InstanceCatalog(query_regions(regions, catalog_config, services))
+
+def optimize_fleet(catalog, fleet_config, filters=None):
+    """
+    机队组合求解：在过滤后的EC2目录中寻找满足总vCPU/内存需求的最低成本组合（可跨区域）
+    贪心求解：每步选择“单位剩余需求成本”最低的机型，并限制单个机型系列占比来保证多样性，
+    最后去掉多余的台数，同时给出成本下界用于评估结果
+    """
+    pricing = fleet_config.get('pricing', 'ondemand')
+    need_cpu = float(fleet_config.get('vcpu') or 0)
+    need_mem = float(fleet_config.get('memory_gb') or 0)
+    min_families = max(1, int(fleet_config.get('min_families', 1)))
+    # 显式配置的占比不能放宽 min_families 的要求，取两者中更严格的
+    share = min(float(fleet_config.get('max_family_share') or 1), 1 / min_families)
+    if need_cpu <= 0 and need_mem <= 0:
+        return None
+
+    prices = catalog.prices[pricing]
+    idx = np.flatnonzero(catalog.mask(filters or {}) & (catalog.service == 'EC2') & (np.nan_to_num(prices) > 0))
+    if not len(idx):
+        return None
+    cpu, mem, price = catalog.cpu[idx], catalog.memory_gb[idx], prices[idx]
+    families, family_index = np.unique([t.split('.')[0] for t in catalog.instance_type[idx]], return_inverse=True)
+
+    # 单个系列的上限按主要需求维度计算（有vCPU需求时按vCPU，否则按内存）
+    primary = cpu if need_cpu else mem
+    family_cap = share * (need_cpu or need_mem)
+    family_used = np.zeros(len(families))
+    counts = np.zeros(len(idx), dtype=int)
+    rem_cpu, rem_mem = need_cpu, need_mem
+
+    while rem_cpu > 1e-9 or rem_mem > 1e-9:
+        room = family_cap - family_used[family_index]
+        cover = np.zeros(len(idx))
+        if need_cpu:
+            cover += np.minimum(cpu, max(rem_cpu, 0)) / need_cpu
+        if need_mem:
+            cover += np.minimum(mem, max(rem_mem, 0)) / need_mem
+        score = np.where((cover > 0) & (primary <= room + 1e-9), price / np.where(cover > 0, cover, 1), np.inf)
+        best = int(np.argmin(score))
+        if not np.isfinite(score[best]):
+            break
+        # 两个维度都还有剩余需求时批量加入，避免逐台迭代
+        limits = [room[best] // primary[best]]
+        if rem_cpu > 0 and cpu[best] > 0:
+            limits.append(rem_cpu // cpu[best])
+        if rem_mem > 0 and mem[best] > 0:
+            limits.append(rem_mem // mem[best])
+        n = int(max(1, min(limits)))
+        counts[best] += n
+        family_used[family_index[best]] += n * primary[best]
+        rem_cpu -= n * cpu[best]
+        rem_mem -= n * mem[best]
+
+    feasible = rem_cpu <= 1e-9 and rem_mem <= 1e-9
+    # 从单价高的机型开始去掉多余台数
+    for i in np.argsort(-price):
+        while counts[i] > 0 and (counts @ cpu) - cpu[i] >= need_cpu and (counts @ mem) - mem[i] >= need_mem:
+            remaining_families = np.unique(family_index[(counts - (np.arange(len(idx)) == i)) > 0])
+            if len(remaining_families) < min(min_families, len(np.unique(family_index[counts > 0]))):
+                break
+            counts[i] -= 1
+
+    selected = np.flatnonzero(counts)
+    lower_bound = max(need_cpu * np.min(price / np.where(cpu > 0, cpu, np.nan)) if need_cpu else 0,
+                      need_mem * np.min(price / np.where(mem > 0, mem, np.nan)) if need_mem else 0)
+    return {
+        'pricing': pricing,
+        'feasible': feasible,
+        'mix': [(catalog.rows[idx[i]], int(counts[i])) for i in selected[np.argsort(-counts[selected])]],
+        'instances': int(counts.sum()),
+        'vcpu': float(counts @ cpu),
+        'memory_gb': float(counts @ mem),
+        'families': sorted({str(families[family_index[i]]) for i in selected}),
+        'hourly': float(counts @ price),
+        'lower_bound': float(lower_bound)
+    }
+
+def print_fleet_mix(fleet, output_file=None):
+    if not fleet:
+        print("机队组合：没有符合条件的机型或未指定需求")
+        return
+    print(f"\n机队组合（价格类型: {fleet['pricing']}）：")
+    print("  区域 | 机型 | 数量 | vCPU | 内存(GB) | 单价/小时 | 小计/小时")
+    rows = []
+    for result, count in fleet['mix']:
+        unit_price = result[fleet['pricing']]
+        rows.append([result['region'], result['instance_type'], count, result['cpu'] * count,
+                     result['memory_gb'] * count, unit_price, unit_price * count])
+        print("  " + " | ".join(str(round(v, 4)) if isinstance(v, float) else str(v) for v in rows[-1]))
+    print(f"总计: {fleet['instances']}台, {len(fleet['families'])}个系列, vCPU {fleet['vcpu']:.0f}, 内存 {fleet['memory_gb']:.0f}GB, "
+          f"${fleet['hourly']:.4f}/小时, ${fleet['hourly'] * 730:.2f}/月（成本下界 ${fleet['lower_bound']:.4f}/小时）")
+    if not fleet['feasible']:
+        print("Warning: 在当前过滤条件和系列占比限制下无法满足全部需求")
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['region', 'instance_type', 'count', 'vcpu', 'memory_gb', 'unit_price_hourly', 'subtotal_hourly'])
+            writer.writerows(rows)
+        print(f"机队组合已保存: {output_file}")
+
+RAWDATA_MODE_PREFIX = 'mode-'
+
+def parse_rawdata_benchmarks(lines, use_cpu, threads):
+    """
+    解析 graviton-cpu-test 的 rawdata.csv：分段格式，段标题行为 `[IP] 机型系列.x`，
+    数据行为 mode,threads,耗时,cpu占用，mode 形如 mode-<架构>-<方法>-inc-<use_cpu>。
+    每个系列取标准方法（mode-<架构>-0-inc-<use_cpu>）在指定线程数下的耗时，
+    耗时越低性能越好，得分取 1e6/耗时，按单个vCPU计算（系列得分）
+    """
+    benchmarks = {}
+    family = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('['):
+            continue
+        if not line.startswith(RAWDATA_MODE_PREFIX):
+            family = line.split()[-1].split('.')[0]
+            continue
+        fields = line.split(',')
+        if family is None or len(fields) < 3:
+            continue
+        mode_parts = fields[0].split('-')
+        # mode-<arch>-0-inc-<n>，排除 prostatbind 等其他方法的变体
+        if len(mode_parts) != 5 or mode_parts[2] != '0' or mode_parts[4] != str(use_cpu):
+            continue
+        try:
+            if int(fields[1]) != threads:
+                continue
+            elapsed = float(fields[2])
+        except ValueError:
+            continue
+        if elapsed > 0:
+            benchmarks[family] = 1e6 / elapsed
+    return benchmarks
+
+def load_benchmarks(benchmark_file, use_cpu=1, threads=40):
+    """
+    读取基准测试得分，支持两种格式：
+    1. CSV，列为 instance_type,score（得分越高性能越好），instance_type 可以是具体机型（如 m6g.xlarge），
+       也可以是机型系列（如 m6g），系列得分按每vCPU计算
+    2. graviton-cpu-test 的 rawdata.csv 分段原始数据，按 use_cpu 和 threads 选取每个系列的测试行
+    """
+    with open(benchmark_file, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    header = lines[0].split(',') if lines else []
+    if 'instance_type' in header and 'score' in header:
+        benchmarks = {}
+        for row in csv.DictReader(lines):
+            if row.get('instance_type') and row.get('score'):
+                benchmarks[row['instance_type'].strip()] = float(row['score'])
+    else:
+        benchmarks = parse_rawdata_benchmarks(lines, use_cpu, threads)
+    if not benchmarks:
+        print(f"Error: 基准测试文件 {benchmark_file} 中没有解析到任何得分，"
+              f"需要 instance_type,score 格式，或 rawdata.csv 中包含 use_cpu={use_cpu}、threads={threads} 的测试行")
+        sys.exit(1)
+    print(f"已加载 {len(benchmarks)} 个基准测试得分: {', '.join(sorted(benchmarks))}")
+    return benchmarks
+
+def apply_benchmarks(results, benchmarks):
+    """为每个结果计算性能得分，以及各种价格下每单位性能的小时成本"""
+    for result in results:
+        instance_type = result['instance_type']
+        if instance_type in benchmarks:
+            score = benchmarks[instance_type]
+        elif instance_type.split('.')[0] in benchmarks:
+            score = benchmarks[instance_type.split('.')[0]] * result['cpu']
+        else:
+            continue
+        if score <= 0:
+            continue
+        result['perf_score'] = score
+        for key in PRICE_KEYS:
+            if result.get(key):
+                result[f'{key}_per_perf'] = result[key] / score
+    return results
+
+def perf_rank_key(result, price_key):
+    """按性能成本从低到高排序，没有得分的排在最后并保持原顺序"""
+    value = result.get(f'{price_key}_per_perf')
+    return (value is None, value or 0)
+
+RI_LABELS = {
+    'ri_1y_no_upfront': 'RI-1年NoUp', 'ri_1y_partial_upfront': 'RI-1年PartUp', 'ri_1y_all_upfront': 'RI-1年AllUp',
+    'ri_3y_no_upfront': 'RI-3年NoUp', 'ri_3y_partial_upfront': 'RI-3年PartUp', 'ri_3y_all_upfront': 'RI-3年AllUp'
+}
+SP_LABELS = {'sp_compute_1y': 'SP-Compute-1年', 'sp_compute_3y': 'SP-Compute-3年',
+             'sp_instance_1y': 'SP-Instance-1年', 'sp_instance_3y': 'SP-Instance-3年'}
+
+def report_layout(results, config):
+    """计算报告的列布局，列号对应的字母只计算一次，所有行共用"""
     pricing_types = config.get('pricing_types', {'ondemand': True})
-    base_headers = ['服务', '实例类型', 'CPU核心数', '内存(GB)', '存储(GB)', '网络性能']
+    base_headers = ['服务', '实例类型', 'CPU核心数', '内存(GB)', '存储(GB)', '网络性能'] + [label for _, label in SPEC_FIELDS]
     if config.get('public_ip'):
         base_headers.extend(['公网IP数量', '单IP成本'])
     
@@ -391,127 +1180,285 @@ def generate_excel(results, output_file, config):
         hourly_headers.append('按需/小时')
         monthly_headers.append('按需/月')
     
-    ri_labels = {
-        'ri_1y_no_upfront': 'RI-1年NoUp', 'ri_1y_partial_upfront': 'RI-1年PartUp', 'ri_1y_all_upfront': 'RI-1年AllUp',
-        'ri_3y_no_upfront': 'RI-3年NoUp', 'ri_3y_partial_upfront': 'RI-3年PartUp', 'ri_3y_all_upfront': 'RI-3年AllUp'
-    }
-    
-    for key, label in ri_labels.items():
+    for key, label in list(RI_LABELS.items()) + list(SP_LABELS.items()):
         if pricing_types.get(key):
             price_keys.append(key)
-            hourly_headers.extend([f'{label}/小时'])
-            monthly_headers.extend([f'{label}/月'])
-    
-    for sp_key, sp_label in [('sp_compute_1y', 'SP-Compute-1年'), ('sp_compute_3y', 'SP-Compute-3年'),
-                              ('sp_instance_1y', 'SP-Instance-1年'), ('sp_instance_3y', 'SP-Instance-3年')]:
-        if pricing_types.get(sp_key):
-            price_keys.append(sp_key)
-            hourly_headers.append(f'{sp_label}/小时')
-            monthly_headers.append(f'{sp_label}/月')
+            hourly_headers.append(f'{label}/小时')
+            monthly_headers.append(f'{label}/月')
     
+    spot_fields = []
     if pricing_types.get('spot'):
         price_keys.append('spot')
-        hourly_headers.extend(['Spot均价/小时'])
-        monthly_headers.extend(['Spot均价/月'])
+        hourly_headers.append('Spot-P50/小时')
+        monthly_headers.append('Spot-P50/月')
+        spot_fields = SPOT_FIELDS
     
-    headers = base_headers + hourly_headers + monthly_headers
-    header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
-    header_font = Font(bold=True, color='FFFFFF')
+    # 提供基准测试得分时，增加每单位性能的小时成本列，并按性能价格比排序
+    has_perf = any('perf_score' in result for result in results)
+    perf_headers = ['性能得分'] + [h.replace('/小时', '/性能') for h in hourly_headers] if has_perf else []
+    
+    headers = base_headers + hourly_headers + monthly_headers + [label for _, label in spot_fields] + perf_headers
+    hourly_col_start = len(base_headers) + 1
+    score_col = hourly_col_start + 2 * len(price_keys) + len(spot_fields)
+    return {
+        'headers': headers,
+        'price_keys': price_keys,
+        'spot_fields': spot_fields,
+        'has_perf': has_perf,
+        'public_ip': bool(config.get('public_ip')),
+        'ip_count_letter': get_column_letter(len(base_headers) - 1),
+        'ondemand_letter': get_column_letter(hourly_col_start) if pricing_types.get('ondemand') else None,
+        'hourly_letters': [get_column_letter(hourly_col_start + i) for i in range(len(price_keys))],
+        'score_letter': get_column_letter(score_col)
+    }
+
+def report_row(result, layout, row_idx=None):
+    """
+    生成一行报告数据，row_idx 不为空时关联列使用excel公式，
+    否则直接计算数值（用于CSV/Parquet输出）
+    """
+    row = [result['service'], result['instance_type'], result['cpu'], result['memory_gb'], result['storage_gb'],
+           str(result['network_gbps'])]
+    row.extend(result.get(field, '') for field, _ in SPEC_FIELDS)
+    hourly = [result.get(key, 0) for key in layout['price_keys']]
+    
+    if layout['public_ip']:
+        ip_count = result.get('public_ip_count', 0)
+        row.append(ip_count)
+        if not layout['ondemand_letter']:
+            row.append(None)
+        elif row_idx:
+            row.append(f"={layout['ondemand_letter']}{row_idx}/{layout['ip_count_letter']}{row_idx}")
+        else:
+            row.append(result.get('ondemand', 0) / ip_count if ip_count else None)
+    
+    row.extend(hourly)
+    if row_idx:
+        row.extend(f"={letter}{row_idx}*730" for letter in layout['hourly_letters'])
+    else:
+        row.extend(price * 730 for price in hourly)
     
+    row.extend(result.get(field, '') for field, _ in layout['spot_fields'])
+    
+    if layout['has_perf']:
+        score = result.get('perf_score')
+        row.append(score)
+        if row_idx:
+            score_letter = layout['score_letter']
+            row.extend(f'=IF(N({score_letter}{row_idx})>0,{letter}{row_idx}/{score_letter}{row_idx},"")'
+                       for letter in layout['hourly_letters'])
+        else:
+            row.extend(price / score if score else None for price in hourly)
+    return row
+
+def group_by_region(results, layout):
     region_results = {}
     for result in results:
         region_results.setdefault(result['region'], []).append(result)
+    if layout['has_perf'] and layout['price_keys']:
+        for region_data in region_results.values():
+            region_data.sort(key=lambda r: perf_rank_key(r, layout['price_keys'][0]))
+    return region_results
+
+def generate_excel(results, output_file, config, crossover_rows=None):
+    """使用 write_only 模式流式写入，行数据写出后不再保留在内存中"""
+    wb = Workbook(write_only=True)
+    layout = report_layout(results, config)
+    headers = layout['headers']
+    header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
+    header_font = Font(bold=True, color='FFFFFF')
     
-    for region, region_data in region_results.items():
+    for region, region_data in group_by_region(results, layout).items():
         ws = wb.create_sheet(title=region)
+        # write_only 模式下列宽需要在写入数据前设置
+        for col in range(1, len(headers) + 1):
+            ws.column_dimensions[get_column_letter(col)].width = 14
         start_row = 1
         
         if config.get('public_ip'):
-            ws.cell(row=1, column=1, value=f"DTO价格: {get_dto_price(region)}")
-            ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(headers))
+            ws.append([f"DTO价格: {get_dto_price(region)}"])
+            ws.merged_cells.add(f"A1:{get_column_letter(len(headers))}1")
+            ws.append([])
             start_row = 3
         
-        # 批量写入表头
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=start_row, column=col, value=header)
+        header_cells = []
+        for header in headers:
+            cell = WriteOnlyCell(ws, value=header)
             cell.fill, cell.font = header_fill, header_font
+            header_cells.append(cell)
+        ws.append(header_cells)
         
-        # 批量写入数据
         for row_idx, result in enumerate(region_data, start_row + 1):
-            col = 1
-            for field in ['service', 'instance_type', 'cpu', 'memory_gb', 'storage_gb']:
-                ws.cell(row=row_idx, column=col, value=result[field])
-                col += 1
-            ws.cell(row=row_idx, column=col, value=str(result['network_gbps']))
-            col += 1
-            
-            if config.get('public_ip'):
-                ip_count_col = col
-                ws.cell(row=row_idx, column=col, value=result.get('public_ip_count', 0))
-                col += 1
-                # 单IP成本列暂时留空，后面用公式填充
-                single_ip_cost_col = col
-                col += 1
-            
-            hourly_col_start = col
-            ondemand_hourly_col = col if pricing_types.get('ondemand') else None
-            
-            for price_key in price_keys:
-                ws.cell(row=row_idx, column=col, value=result.get(price_key, 0))
-                col += 1
-            
-            # 填充单IP成本公式
-            if config.get('public_ip') and ondemand_hourly_col:
-                def col_letter(col_num):
-                    if col_num <= 26:
-                        return chr(64 + col_num)
-                    else:
-                        return chr(64 + (col_num - 1) // 26) + chr(64 + (col_num - 1) % 26 + 1)
-                
-                ondemand_col_letter = col_letter(ondemand_hourly_col)
-                ip_count_col_letter = col_letter(ip_count_col)
-                ws.cell(row=row_idx, column=single_ip_cost_col, 
-                       value=f"={ondemand_col_letter}{row_idx}/{ip_count_col_letter}{row_idx}")
-            
-            for i in range(len(price_keys)):
-                def col_letter(col_num):
-                    if col_num <= 26:
-                        return chr(64 + col_num)
-                    else:
-                        return chr(64 + (col_num - 1) // 26) + chr(64 + (col_num - 1) % 26 + 1)
-                
-                col_letter_str = col_letter(hourly_col_start + i)
-                ws.cell(row=row_idx, column=col, value=f"={col_letter_str}{row_idx}*730")
-                col += 1
-        
-        for col in range(1, len(headers) + 1):
-            ws.column_dimensions[chr(64 + col) if col <= 26 else f"A{chr(64 + col - 26)}"].width = 14
+            ws.append(report_row(result, layout, row_idx))
+    
+    if crossover_rows:
+        ws = wb.create_sheet(title='Lambda对比')
+        ws.append(CROSSOVER_HEADERS)
+        for row in crossover_rows:
+            ws.append(crossover_row(row))
     
     wb.save(output_file)
     print(f"报告已生成: {output_file}")
 
+def generate_table(results, output_file, config, output_format='csv'):
+    """输出为单个CSV或Parquet文件，增加区域列，关联列直接计算为数值"""
+    layout = report_layout(results, config)
+    headers = ['区域'] + layout['headers']
+    if output_format == 'csv':
+        with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(headers)
+            for region, region_data in group_by_region(results, layout).items():
+                writer.writerows([region] + report_row(result, layout) for result in region_data)
+    else:
+        # 仅 parquet 输出需要 pyarrow
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        rows = [[region] + report_row(result, layout)
+                for region, region_data in group_by_region(results, layout).items() for result in region_data]
+        columns = {header: [None if v == '' else v for v in values] for header, values in zip(headers, zip(*rows))} if rows else {h: [] for h in headers}
+        pq.write_table(pa.table({h: pa.array(v, from_pandas=True) for h, v in columns.items()}), output_file)
+    print(f"报告已生成: {output_file}")
+
+def write_snapshot(results, snapshot_dir):
+    """保存原始结果为Parquet快照：数值列为float64，其余列为字符串；未安装pyarrow时跳过"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Warning: 未安装 pyarrow，跳过保存快照（pip install pyarrow 后可使用 --diff）")
+        return None
+    os.makedirs(snapshot_dir, exist_ok=True)
+    keys = list(dict.fromkeys(k for r in results for k in r))
+    columns = {}
+    for key in keys:
+        values = [r.get(key) for r in results]
+        if all(v is None or v == '' or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values):
+            columns[key] = pa.array([None if v == '' else v for v in values], type=pa.float64())
+        else:
+            columns[key] = pa.array([None if v is None else str(v) for v in values], type=pa.string())
+    snapshot_file = os.path.join(snapshot_dir, f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.parquet")
+    pq.write_table(pa.table(columns), snapshot_file)
+    print(f"快照已保存: {snapshot_file}")
+    return snapshot_file
+
+def read_snapshot(snapshot_file):
+    import pyarrow.parquet as pq
+    return {tuple(r[k] for k in SNAPSHOT_KEY): r for r in pq.read_table(snapshot_file).to_pylist()}
+
+def latest_snapshots(snapshot_dir, count=2):
+    files = sorted(f for f in os.listdir(snapshot_dir) if f.startswith('snapshot_') and f.endswith('.parquet')) \
+        if os.path.isdir(snapshot_dir) else []
+    return [os.path.join(snapshot_dir, f) for f in files[-count:]]
+
+def diff_snapshots(old_file, new_file, threshold=DIFF_THRESHOLD):
+    """
+    按 (区域, 服务, 机型) 关联两个快照，返回新增/下线机型，
+    以及各价格类型变化幅度超过 threshold(%) 的记录
+    """
+    old, new = read_snapshot(old_file), read_snapshot(new_file)
+    changes = []
+    for key in sorted(new.keys() - old.keys()):
+        changes.append(dict(zip(SNAPSHOT_KEY, key), change='新增', price_key='ondemand', old=None, new=new[key].get('ondemand'), delta_pct=None))
+    for key in sorted(old.keys() - new.keys()):
+        changes.append(dict(zip(SNAPSHOT_KEY, key), change='下线', price_key='ondemand', old=old[key].get('ondemand'), new=None, delta_pct=None))
+    for key in sorted(old.keys() & new.keys()):
+        for price_key in PRICE_KEYS:
+            old_price, new_price = old[key].get(price_key), new[key].get(price_key)
+            if not old_price or not new_price:
+                continue
+            delta_pct = (new_price - old_price) / old_price * 100
+            if abs(delta_pct) >= threshold:
+                changes.append(dict(zip(SNAPSHOT_KEY, key), change='降价' if delta_pct < 0 else '涨价', price_key=price_key,
+                                    old=old_price, new=new_price, delta_pct=round(delta_pct, 2)))
+    return changes
+
+DIFF_HEADERS = ['区域', '服务', '机型', '变化', '价格类型', '原价格/小时', '新价格/小时', '变化(%)']
+
+def print_diff(changes, old_file, new_file, output_file=None):
+    print(f"对比 {old_file} -> {new_file}")
+    if not changes:
+        print("没有超过阈值的变化")
+        return
+    counts = {}
+    for c in changes:
+        counts[c['change']] = counts.get(c['change'], 0) + 1
+    print('，'.join(f"{k} {v}" for k, v in counts.items()))
+    rows = [[c['region'], c['service'], c['instance_type'], c['change'], c['price_key'], c['old'], c['new'], c['delta_pct']]
+            for c in changes]
+    for row in rows[:50]:
+        print('  ' + ' | '.join('' if v is None else str(v) for v in row))
+    if len(rows) > 50:
+        print(f"  ... 共 {len(rows)} 条")
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(DIFF_HEADERS)
+            writer.writerows(rows)
+        print(f"变化明细已保存: {output_file}")
+
 def main():
     parser = argparse.ArgumentParser(description='AWS机型选择程序')
     parser.add_argument('-c', '--config', default='config.yaml', help='配置文件路径')
+    parser.add_argument('--refresh', action='store_true', help='忽略本地缓存，重新查询所有数据')
+    parser.add_argument('--format', choices=['xlsx', 'csv', 'parquet'], default='xlsx', help='报告格式（默认xlsx）')
+    parser.add_argument('--diff', nargs='*', metavar='SNAPSHOT',
+                        help='对比两个快照（不指定时对比快照目录中最近两次运行），有变化时退出码为1')
+    parser.add_argument('--threshold', type=float, help=f'价格变化阈值(%%)，默认{DIFF_THRESHOLD}')
     args = parser.parse_args()
     
     config = load_config(args.config)
+    snapshot_config = config.get('snapshot') or {}
+    snapshot_dir = snapshot_config.get('dir', SNAPSHOT_DIR)
+    if args.diff is not None:
+        files = args.diff or latest_snapshots(snapshot_dir)
+        if len(files) != 2:
+            print("Error: 需要两个快照文件进行对比")
+            sys.exit(2)
+        threshold = args.threshold if args.threshold is not None else snapshot_config.get('threshold', DIFF_THRESHOLD)
+        changes = diff_snapshots(files[0], files[1], threshold)
+        print_diff(changes, files[0], files[1], f"snapshot_diff_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv" if changes else None)
+        sys.exit(1 if changes else 0)
+    
+    init_cache(config.get('cache'), args.refresh)
+    network_config = config.get('network') or {}
+    if network_config.get('pps_min') is not None or network_config.get('pps_max') is not None:
+        print("Warning: EC2 API 不提供 PPS 数据，network.pps_min/pps_max 不参与过滤")
     regions = config.get('regions', ['us-east-1'])
     services = config.get('services', ['lightsail', 'ec2', 'lambda'])
+    concurrency = config.get('concurrency') or {}
+    get_price_executor(concurrency.get('prices', PRICE_WORKERS))
     
-    # 并发查询多个区域
-    all_results = []
-    with ThreadPoolExecutor(max_workers=min(len(regions), 5)) as executor:
-        futures = {executor.submit(query_region, region, config, services): region for region in regions}
-        for future in as_completed(futures):
-            try:
-                all_results.extend(future.result())
-            except Exception as e:
-                print(f"区域查询失败: {e}")
+    all_results = query_regions(regions, config, services, concurrency.get('regions', REGION_WORKERS))
+    if config.get('benchmark_file'):
+        apply_benchmarks(all_results, load_benchmarks(config['benchmark_file'],
+                                                      config.get('benchmark_use_cpu', 1),
+                                                      config.get('benchmark_threads', 40)))
     
-    output_file = f"aws_instance_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    generate_excel(all_results, output_file, config)
+    crossover_rows = None
+    if config.get('lambda_workload'):
+        crossover_rows, crossovers = lambda_crossover(all_results, config['lambda_workload'])
+        print_crossover(crossovers, config['lambda_workload'])
+    
+    output_file = f"aws_instance_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{args.format}"
+    if args.format == 'xlsx':
+        generate_excel(all_results, output_file, config, crossover_rows)
+    else:
+        generate_table(all_results, output_file, config, args.format)
+        if crossover_rows:
+            crossover_file = f"lambda_crossover_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            with open(crossover_file, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(CROSSOVER_HEADERS)
+                writer.writerows(crossover_row(row) for row in crossover_rows)
+            print(f"Lambda对比已保存: {crossover_file}")
     print(f"\n共找到 {len(all_results)} 个符合条件的配置")
+    if snapshot_config.get('enabled', True):
+        write_snapshot(all_results, snapshot_dir)
+    
+    if config.get('fleet'):
+        fleet = optimize_fleet(InstanceCatalog(all_results), config['fleet'])
+        print_fleet_mix(fleet, f"fleet_mix_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
 
 if __name__ == '__main__':
     main()
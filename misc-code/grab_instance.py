@@ -1,13 +1,53 @@
 #!/usr/bin/env python3
-"""Script to grab GPU instances via On-Demand, Spot, EC2 Capacity Blocks, or SageMaker Training Plans."""
+"""Script to grab GPU instances via On-Demand, Spot, EC2 Fleet, EC2 Capacity Blocks, or SageMaker Training Plans."""
 
 import argparse
+import itertools
 import json
+import os
+import sqlite3
+import threading
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Clients are shared by all probe threads; keep botocore retries short so a
+# throttled call does not hold a worker while capacity is appearing elsewhere.
+CLIENT_CONFIG = Config(retries={"mode": "standard", "max_attempts": 3}, max_pool_connections=50)
+
+ONDEMAND_RETRY_CODES = ("InsufficientInstanceCapacity", "InstanceLimitExceeded", "Unsupported", "InvalidParameterValue")
+SPOT_RETRY_CODES = ("InsufficientInstanceCapacity", "SpotMaxPriceTooLow", "Unsupported", "InvalidParameterValue")
+# Spot requests only count towards --count once fulfilled; ones still open after
+# --fulfill-timeout are cancelled and the attempt is scheduled like a capacity error.
+SPOT_UNFULFILLED = "Unfulfilled"
+SPOT_POLL_INTERVAL = 5
+
+# Adaptive retry scheduling: capacity errors back off exponentially per (region, AZ, type);
+# types not offered in an AZ are parked for an hour; AZs with a recent success keep the base interval.
+NOT_OFFERED_CODES = ("Unsupported", "InvalidParameterValue")
+NOT_OFFERED_BACKOFF = 3600
+RECENT_SUCCESS_WINDOW = 3600
+PLACEMENT_SCORE_TTL = 3600
+HOUR_RATES_TTL = 300
+
+AL2023_AMI_PARAM = "/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-default-x86_64"
+
+_clients = {}
+_clients_lock = threading.Lock()
+_print_lock = threading.Lock()
+_contexts = {}
+_contexts_lock = threading.Lock()
+_refresher_started = threading.Event()
+_placement_groups = set()
+_history = None
+_history_lock = threading.Lock()
+_schedule = {}
+_placement_scores = {"built": 0, "scores": {}}
+_hour_rates = {"built": 0, "hour": None, "rates": {}}
 
 
 # ── Shared helpers ──────────────────────────────────────────────────────────
@@ -38,16 +78,23 @@ def resolve_azs(ec2, az_name_or_id=None, include_local_zones=False):
     return result
 
 
-def find_subnet_in_az(ec2, az_name):
-    """Find a subnet in the given AZ."""
-    resp = ec2.describe_subnets(
-        Filters=[{"Name": "availability-zone", "Values": [az_name]}]
-    )
-    return resp["Subnets"][0]["SubnetId"] if resp["Subnets"] else None
+def find_subnets(ec2, az_names):
+    """Find one subnet per AZ with a single describe_subnets call, as {az_name: subnet_id}."""
+    subnets = {}
+    paginator = ec2.get_paginator("describe_subnets")
+    for page in paginator.paginate(Filters=[{"Name": "availability-zone", "Values": list(az_names)}]):
+        for subnet in page["Subnets"]:
+            subnets.setdefault(subnet["AvailabilityZone"], subnet["SubnetId"])
+    return subnets
 
 
-def get_latest_ami(ec2):
-    """Get latest Amazon Linux 2023 AMI."""
+def get_latest_ami(ec2, region=None):
+    """Get latest Amazon Linux 2023 AMI from the public SSM parameter, falling back to describe_images."""
+    if region:
+        try:
+            return get_client("ssm", region).get_parameter(Name=AL2023_AMI_PARAM)["Parameter"]["Value"]
+        except ClientError:
+            pass
     resp = ec2.describe_images(
         Owners=["amazon"],
         Filters=[
@@ -60,342 +107,958 @@ def get_latest_ami(ec2):
     return images[0]["ImageId"] if images else None
 
 
-# ── Mode 1: On-Demand (retry loop) ─────────────────────────────────────────
+def log(msg):
+    """Print from worker threads without interleaving lines."""
+    with _print_lock:
+        print(msg, flush=True)
+
+
+def get_client(service, region):
+    """Return one shared client per (service, region); boto3 clients are thread-safe."""
+    with _clients_lock:
+        key = (service, region)
+        if key not in _clients:
+            _clients[key] = boto3.client(service, region_name=region, config=CLIENT_CONFIG)
+        return _clients[key]
+
+
+# ── Launch context cache ────────────────────────────────────────────────────
+
+def build_launch_context(args, region):
+    """Look up the AZs, AMI and per-AZ subnets for a region, or None if it cannot be used."""
+    ec2 = get_client("ec2", region)
+    azs = resolve_azs(ec2, args.az, args.include_local_zones)
+    if not azs:
+        log(f"WARNING: Cannot resolve AZ '{args.az}' in region {region}, skipping")
+        return None
+    ami_id = args.ami or get_latest_ami(ec2, region)
+    if not ami_id:
+        log(f"WARNING: Cannot find AMI in {region}, skipping")
+        return None
+    subnets = subnet_az(ec2, args.subnet) if args.subnet else find_subnets(ec2, [n for n, _ in azs])
+    return {"azs": azs, "ami_id": ami_id, "subnets": subnets, "built": time.time()}
+
+
+def subnet_az(ec2, subnet_id):
+    """Map an explicit --subnet to its AZ ({az: subnet}) so fleet results can be pinned by AZ name."""
+    try:
+        resp = ec2.describe_subnets(SubnetIds=[subnet_id])
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "InvalidSubnetID.NotFound":
+            raise
+        return {}  # --subnet belongs to another region
+    return {s["AvailabilityZone"]: s["SubnetId"] for s in resp["Subnets"]}
+
+
+def get_launch_context(args, region):
+    """Return the cached launch context for a region, building it on first use."""
+    with _contexts_lock:
+        if region in _contexts:
+            return _contexts[region]
+    context = build_launch_context(args, region)
+    with _contexts_lock:
+        _contexts[region] = context
+    return context
+
+
+def refresh_launch_contexts(args, regions):
+    """Rebuild every region's context; keep the previous one if a lookup fails or comes back empty."""
+    for region in regions:
+        try:
+            context = build_launch_context(args, region)
+        except (ClientError, BotoCoreError) as e:
+            log(f"WARNING: Cannot refresh launch context for {region}: {e}")
+            continue
+        if context is None:
+            continue
+        with _contexts_lock:
+            _contexts[region] = context
+
+
+def init_launch_contexts(args):
+    """Build all region contexts in parallel at startup, then refresh them every args.context_ttl seconds."""
+    regions = args.region.split(',')
+    with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+        list(pool.map(lambda r: get_launch_context(args, r), regions))
 
-def run_ondemand(args):
+    def refresher():
+        while True:
+            time.sleep(args.context_ttl)
+            try:
+                refresh_launch_contexts(args, regions)
+            except Exception as e:  # keep refreshing; a dead thread would freeze the contexts silently
+                log(f"WARNING: Launch context refresh failed: {e}")
+
+    if args.context_ttl > 0 and not _refresher_started.is_set():
+        _refresher_started.set()
+        threading.Thread(target=refresher, daemon=True).start()
+
+
+# ── Concurrent prober ───────────────────────────────────────────────────────
+
+def region_attempts(args, region):
+    """Build the (AZ, instance type) attempts for one region from its cached launch context."""
+    context = get_launch_context(args, region)
+    if not context:
+        return []
+    attempts = []
+    for az_name, az_id in context["azs"]:
+        if args.subnet and context["subnets"] and az_name not in context["subnets"]:
+            continue  # an explicit --subnet only launches in its own AZ
+        subnet_id = args.subnet or context["subnets"].get(az_name)
+        for instance_type in args.instance_type.split(','):
+            attempts.append({"region": region, "az": az_name, "az_id": az_id, "instance_type": instance_type,
+                             "ami_id": context["ami_id"], "subnet_id": subnet_id})
+    return attempts
+
+
+def build_attempts(args):
+    """Interleave the regions' attempts so workers spread across regions."""
+    per_region = [region_attempts(args, r) for r in args.region.split(',')]
+    return [a for group in itertools.zip_longest(*per_region) for a in group if a]
+
+
+def probe(attempts, launch, release, retry_codes, args, counter, state):
+    """
+    Fire attempts concurrently with up to args.workers in flight. Each attempt asks for the
+    count not yet held or requested by other in-flight attempts (state["in_flight"]), but
+    at least one, so every attempt still probes its AZ while the overshoot stays bounded
+    by one instance per extra worker. Kept resources are added to `state`; once args.count
+    is reached no new attempts start and surplus from attempts already in flight is
+    released. With --same-az, the first AZ to succeed is pinned and results elsewhere
+    are released. Returns False on dry run.
+    """
+    stop = threading.Event()
+    lock = threading.Lock()
+    fatal, dry_run = [], []
+
+    def worker(attempt):
+        where = f"{attempt['region']}/{attempt['az']}"
+        with lock:
+            remaining = args.count - len(state["resources"])
+            if stop.is_set() or remaining <= 0 or (args.same_az and state["az"] not in (None, where)):
+                return
+            want = max(remaining - state["in_flight"], 1)
+            if args.max_retries and counter["attempts"] >= args.max_retries:
+                stop.set()
+                return
+            counter["attempts"] += 1
+            n = counter["attempts"]
+            state["in_flight"] += want
+        ec2 = get_client("ec2", attempt["region"])
+        log(f"[Attempt {n}] Requesting {want}x {attempt['instance_type']} in {where}...")
+        try:
+            resources = launch(ec2, attempt, args, want)
+        except Exception as e:
+            with lock:
+                state["in_flight"] -= want
+            if not isinstance(e, ClientError):
+                raise
+            code = e.response["Error"]["Code"]
+            msg = e.response["Error"]["Message"]
+            if code == "DryRunOperation":
+                dry_run.append(attempt)
+                stop.set()
+            elif code in retry_codes:
+                log(f"  {where} {attempt['instance_type']} {code}: {msg}")
+                record_attempt(args.mode, attempt, code)
+                schedule_attempt(args, attempt, code)
+            else:
+                fatal.append(f"  ERROR [{code}]: {msg}")
+                stop.set()
+            return
+        if not resources:
+            with lock:
+                state["in_flight"] -= want
+            log(f"  {where} {attempt['instance_type']} {SPOT_UNFULFILLED}: request not fulfilled in time, cancelled")
+            record_attempt(args.mode, attempt, SPOT_UNFULFILLED)
+            schedule_attempt(args, attempt, SPOT_UNFULFILLED)
+            return
+        with lock:
+            state["in_flight"] -= want
+            keep = [] if args.same_az and state["az"] not in (None, where) else \
+                resources[:max(args.count - len(state["resources"]), 0)]
+            if keep:
+                if args.same_az:
+                    state["az"] = where
+                add_resources(args, state, attempt["region"], attempt["az"], attempt["instance_type"], keep)
+                if len(state["resources"]) >= args.count:
+                    stop.set()
+            total = len(state["resources"])
+        record_attempt(args.mode, attempt, "Success", len(resources))
+        schedule_attempt(args, attempt, "Success")
+        for resource in keep:
+            log(f"SUCCESS! {resource} ({attempt['instance_type']}) in {where} [{total}/{args.count}]")
+        for resource in resources[len(keep):]:
+            log(f"  Releasing extra {resource} in {where}")
+            release(ec2, resource)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(worker, attempts))
+    if fatal:
+        # Other workers may have acquired capacity in this sweep; don't leave it running unreported
+        report_held_on_error(state)
+        sys.exit(fatal[0])
+    if dry_run:
+        print("Dry run succeeded - request would have been accepted.")
+        return False
+    return True
+
+
+def candidate_attempts(args, state):
+    """All attempts that may still be useful: with --same-az, only the pinned AZ once one is pinned."""
+    attempts = build_attempts(args)
+    if args.same_az and state["az"]:
+        attempts = [a for a in attempts if f"{a['region']}/{a['az']}" == state["az"]]
+    return attempts
+
+
+def run_probe_loop(args, launch, release, retry_codes):
+    """Sweep due regions × AZs × types concurrently until args.count resources are held, sleeping until the next is due."""
+    state = load_state(args, release)
+    counter = {"attempts": 0}
+    init_history(args.history_db)
+    init_launch_contexts(args)
+    while len(state["resources"]) < args.count:
+        attempts = due_attempts(args, candidate_attempts(args, state))
+        if attempts and not probe(attempts, launch, release, retry_codes, args, counter, state):
+            return None
+        if len(state["resources"]) >= args.count:
+            break
+        check_deadline(args, state, release)
+        if args.max_retries and counter["attempts"] >= args.max_retries:
+            sys.exit(f"\nMax retries ({args.max_retries}) reached.")
+        wait = seconds_until_due(args, candidate_attempts(args, state))
+        print(f"  Have {len(state['resources'])}/{args.count}. Next attempt in {wait:.0f}s...")
+        time.sleep(wait)
+    print_resources(state)
+    return state
+
+
+# ── Attempt history & adaptive scheduling ──────────────────────────────────
+
+def init_history(path):
+    """Open the attempt history database and seed per-key schedules with each key's last success."""
+    global _history
+    _history = sqlite3.connect(path, check_same_thread=False)
+    _history.execute("CREATE TABLE IF NOT EXISTS attempts (ts REAL, mode TEXT, region TEXT, az TEXT, az_id TEXT, "
+                     "instance_type TEXT, code TEXT, launched INTEGER)")
+    _history.execute("CREATE INDEX IF NOT EXISTS attempts_key ON attempts (region, az, instance_type)")
+    for region, az, instance_type, ts in _history.execute(
+            "SELECT region, az, instance_type, MAX(ts) FROM attempts WHERE launched > 0 GROUP BY 1, 2, 3"):
+        _schedule[(region, az, instance_type)] = {"failures": 0, "next": 0, "last_success": ts}
+
+
+def record_attempt(mode, attempt, code, launched=0):
+    if _history is None:
+        return
+    with _history_lock:
+        _history.execute("INSERT INTO attempts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (time.time(), mode, attempt["region"], attempt["az"], attempt.get("az_id"),
+                          attempt["instance_type"], code, launched))
+        _history.commit()
+
+
+def schedule_attempt(args, attempt, code):
+    """Set when this (region, AZ, type) may be tried again, based on the outcome just seen."""
+    key = (attempt["region"], attempt["az"], attempt["instance_type"])
+    now = time.time()
+    with _history_lock:
+        entry = _schedule.setdefault(key, {"failures": 0, "next": 0, "last_success": 0})
+        if code == "Success":
+            entry["failures"], entry["last_success"] = 0, now
+            delay = 0
+        elif code in NOT_OFFERED_CODES:
+            delay = NOT_OFFERED_BACKOFF
+        elif now - entry["last_success"] < RECENT_SUCCESS_WINDOW:
+            delay = args.interval
+        else:
+            entry["failures"] += 1
+            delay = min(args.interval * 2 ** (entry["failures"] - 1), args.max_backoff)
+        entry["next"] = now + delay
+
+
+def hour_success_rates():
+    """
+    Historical launch success rate per (region, AZ, type) for the current UTC hour of day.
+    Recomputed at most every HOUR_RATES_TTL seconds (or when the hour changes), not every sweep.
+    """
+    if _history is None:
+        return {}
+    hour = f"{datetime.now(timezone.utc).hour:02d}"
+    if _hour_rates["hour"] == hour and time.time() - _hour_rates["built"] < HOUR_RATES_TTL:
+        return _hour_rates["rates"]
+    with _history_lock:
+        rows = _history.execute(
+            "SELECT region, az, instance_type, AVG(launched > 0) FROM attempts "
+            "WHERE strftime('%H', ts, 'unixepoch') = ? GROUP BY 1, 2, 3", (hour,)).fetchall()
+    _hour_rates.update(built=time.time(), hour=hour, rates={(r, a, t): rate for r, a, t, rate in rows})
+    return _hour_rates["rates"]
+
+
+def load_placement_scores(args):
+    """Spot placement scores (1-10) per (region, AZ ID), refreshed hourly, used as a capacity prior."""
+    if not args.placement_scores or time.time() - _placement_scores["built"] < PLACEMENT_SCORE_TTL:
+        return _placement_scores["scores"]
     regions = args.region.split(',')
-    instance_types = args.instance_type.split(',')
-    attempt = 0
-    
-    while True:
-        for region in regions:
-            ec2 = boto3.client("ec2", region_name=region)
-            azs = resolve_azs(ec2, args.az, args.include_local_zones)
-            if not azs:
-                print(f"WARNING: Cannot resolve AZ '{args.az}' in region {region}, skipping")
-                continue
-            
-            ami_id = args.ami or get_latest_ami(ec2)
-            if not ami_id:
-                print(f"WARNING: Cannot find AMI in {region}, skipping")
-                continue
-
-            for az_name, az_id in azs:
-                for instance_type in instance_types:
-                    attempt += 1
-                    subnet_id = args.subnet or find_subnet_in_az(ec2, az_name)
-                    try:
-                        print(f"\n[Attempt {attempt}] Requesting {instance_type} in {region}/{az_name}...")
-                        params = {
-                            "ImageId": ami_id,
-                            "InstanceType": instance_type,
-                            "MinCount": 1, "MaxCount": 1,
-                            "Placement": {"AvailabilityZone": az_name},
-                            "DryRun": args.dry_run,
-                            "TagSpecifications": [{"ResourceType": "instance",
-                                                   "Tags": [{"Key": "Name", "Value": f"{instance_type}-{az_name}"}]}],
-                        }
-                        if subnet_id:
-                            params["SubnetId"] = subnet_id
-                        if args.key_name:
-                            params["KeyName"] = args.key_name
-                        resp = ec2.run_instances(**params)
-                        print(f"SUCCESS! Instance: {resp['Instances'][0]['InstanceId']} in {region}")
-                        return
-                    except ClientError as e:
-                        code = e.response["Error"]["Code"]
-                        msg = e.response["Error"]["Message"]
-                        if code == "DryRunOperation":
-                            print("Dry run succeeded - request would have been accepted.")
-                            return
-                        elif code in ("InsufficientInstanceCapacity", "InstanceLimitExceeded", "Unsupported", "InvalidParameterValue"):
-                            print(f"  {code}: {msg}")
-                        else:
-                            sys.exit(f"  ERROR [{code}]: {msg}")
+    ec2 = get_client("ec2", regions[0])
+    scores = {}
+    try:
+        for page in ec2.get_paginator("get_spot_placement_scores").paginate(
+                InstanceTypes=args.instance_type.split(','), TargetCapacity=args.count,
+                SingleAvailabilityZone=True, RegionNames=regions):
+            for item in page["SpotPlacementScores"]:
+                scores[(item["Region"], item["AvailabilityZoneId"])] = item["Score"]
+    except ClientError as e:
+        log(f"WARNING: Cannot get spot placement scores: {e}")
+    _placement_scores.update(built=time.time(), scores=scores)
+    return scores
+
+
+def due_attempts(args, attempts):
+    """Attempts whose backoff has expired, best first: placement score, then success rate at this hour."""
+    now = time.time()
+    scores = load_placement_scores(args)
+    rates = hour_success_rates()
+    due = [a for a in attempts if _schedule.get((a["region"], a["az"], a["instance_type"]), {}).get("next", 0) <= now]
+    return sorted(due, key=lambda a: (-scores.get((a["region"], a["az_id"]), 0),
+                                      -rates.get((a["region"], a["az"], a["instance_type"]), 0)))
+
+
+def seconds_until_due(args, attempts):
+    """Seconds until the next attempt is due; args.interval when no region currently yields any attempt."""
+    if not attempts:
+        log(f"WARNING: No usable region/AZ for {args.instance_type}; checking again in {args.interval}s")
+        return args.interval
+    now = time.time()
+    waits = [_schedule.get((a["region"], a["az"], a["instance_type"]), {}).get("next", 0) - now for a in attempts]
+    return max(min(waits), 0)
+
+
+def run_report(args):
+    """Print launch success by UTC hour of day for each (region, AZ, type) in the history database."""
+    db = sqlite3.connect(args.history_db)
+    since = time.time() - args.days * 86400
+    rows = db.execute(
+        "SELECT region, az, instance_type, strftime('%H', ts, 'unixepoch') AS hour, COUNT(*), SUM(launched > 0) "
+        "FROM attempts WHERE ts >= ? GROUP BY 1, 2, 3, 4 ORDER BY 1, 2, 3, 4", (since,)).fetchall()
+    if not rows:
+        print(f"No attempts recorded in {args.history_db} in the last {args.days} day(s).")
+        return
+    by_key = {}
+    for region, az, instance_type, hour, total, ok in rows:
+        by_key.setdefault((region, az, instance_type), []).append((hour, total, ok))
+    print(f"Launch success by UTC hour, last {args.days} day(s):")
+    print(f"{'Region/AZ':<24} {'Type':<16} {'Attempts':>8} {'Success':>8}  Best hours (success/attempts)")
+    for (region, az, instance_type), hours in sorted(by_key.items(), key=lambda kv: -sum(h[2] for h in kv[1])):
+        total = sum(h[1] for h in hours)
+        ok = sum(h[2] for h in hours)
+        best = sorted((h for h in hours if h[2]), key=lambda h: -h[2] / h[1])[:3]
+        print(f"{region + '/' + az:<24} {instance_type:<16} {total:>8} {ok:>8}  "
+              + (", ".join(f"{h}:00 ({o}/{t})" for h, t, o in best) or "-"))
+    codes = db.execute("SELECT code, COUNT(*) FROM attempts WHERE ts >= ? GROUP BY 1 ORDER BY 2 DESC", (since,)).fetchall()
+    print("\nOutcomes: " + ", ".join(f"{code} x{n}" for code, n in codes))
+
+
+# ── Target count & state ────────────────────────────────────────────────────
+
+def new_state(args):
+    return {"mode": args.mode, "instance_type": args.instance_type, "region": args.region, "count": args.count,
+            "started": time.time(), "az": None, "resources": [], "in_flight": 0}
+
+
+def save_state(args, state):
+    """Atomically rewrite the state file after every change so a restart never double-launches."""
+    if not args.state_file:
+        return
+    tmp = f"{args.state_file}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, args.state_file)
+
+
+def add_resources(args, state, region, az, instance_type, resource_ids):
+    state["resources"].extend({"region": region, "az": az, "instance_type": instance_type, "id": resource_id}
+                              for resource_id in resource_ids)
+    save_state(args, state)
+
+
+def alive_resources(mode, resources):
+    """Drop resources from a previous run that are no longer pending/running (or fulfilled spot requests)."""
+    alive = set()
+    for region in {r["region"] for r in resources}:
+        ids = [r["id"] for r in resources if r["region"] == region]
+        ec2 = get_client("ec2", region)
+        # Filter by ID instead of passing the IDs directly: IDs that have aged out are simply
+        # not returned, whereas the ID parameters raise *.NotFound for the whole call.
+        for i in range(0, len(ids), 200):
+            if mode == "spot":
+                for page in ec2.get_paginator("describe_spot_instance_requests").paginate(
+                        Filters=[{"Name": "spot-instance-request-id", "Values": ids[i:i + 200]}]):
+                    alive.update(r["SpotInstanceRequestId"] for r in page["SpotInstanceRequests"]
+                                 if r["State"] == "active" and r.get("InstanceId"))
+            else:
+                for page in ec2.get_paginator("describe_instances").paginate(
+                        Filters=[{"Name": "instance-id", "Values": ids[i:i + 200]}]):
+                    alive.update(inst["InstanceId"] for res in page["Reservations"] for inst in res["Instances"]
+                                 if inst["State"]["Name"] in ("pending", "running"))
+    return [r for r in resources if r["id"] in alive]
+
+
+def load_state(args, release):
+    """Resume from --state-file: keep still-alive resources and the original start time and pinned AZ."""
+    state = new_state(args)
+    if not args.state_file or not os.path.exists(args.state_file):
+        return state
+    with open(args.state_file) as f:
+        saved = json.load(f)
+    if any(saved.get(k) != state[k] for k in ("mode", "instance_type", "region")):
+        sys.exit(f"State file {args.state_file} belongs to a different request ({saved.get('mode')} "
+                 f"{saved.get('instance_type')} in {saved.get('region')}); remove it or use another --state-file.")
+    saved["resources"] = alive_resources(args.mode, saved["resources"])
+    if not saved["resources"]:
+        saved["az"] = None
+    saved["count"] = args.count
+    saved["in_flight"] = 0
+    print(f"Resuming from {args.state_file}: {len(saved['resources'])}/{args.count} already held"
+          + (f" in {saved['az']}" if saved["az"] else ""))
+    save_state(args, saved)
+    check_deadline(args, saved, release)
+    return saved
+
+
+def check_deadline(args, state, release):
+    """Past --deadline minutes: release partial capacity (unless --keep-partial) and give up."""
+    if not args.deadline or time.time() - state["started"] < args.deadline * 60:
+        return
+    held = len(state["resources"])
+    if held and not args.keep_partial:
+        print(f"\nDeadline reached with {held}/{args.count}; releasing them...")
+        for r in state["resources"]:
+            release(get_client("ec2", r["region"]), r["id"])
+        state["resources"], state["az"] = [], None
+        save_state(args, state)
+    sys.exit(f"\nDeadline ({args.deadline} min) reached with {len(state['resources'])}/{args.count}.")
+
+
+def report_held_on_error(state):
+    if state["resources"]:
+        print_resources(state, "Stopping on error; still holding")
+        print("These are still running. Release them manually or rerun with the same --state-file to resume.")
+
+
+def print_resources(state, title="SUCCESS!"):
+    print(f"\n{title} {len(state['resources'])} resource(s):")
+    for r in state["resources"]:
+        print(f"  {r['id']} {r['instance_type']} {r['region']}/{r['az']}")
+
+
+def ensure_placement_group(ec2, region, name):
+    """Create the cluster placement group in this region on first use."""
+    with _clients_lock:
+        if (region, name) in _placement_groups:
+            return name
+    try:
+        ec2.create_placement_group(GroupName=name, Strategy="cluster")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "InvalidPlacementGroup.Duplicate":
+            raise
+    with _clients_lock:
+        _placement_groups.add((region, name))
+    return name
 
-                    if args.max_retries and attempt >= args.max_retries:
-                        sys.exit(f"\nMax retries ({args.max_retries}) reached.")
 
-        print(f"  Retrying all regions in {args.interval}s...")
-        time.sleep(args.interval)
+# ── Mode 1: On-Demand (retry loop) ─────────────────────────────────────────
+
+def launch_ondemand(ec2, attempt, args, count=1):
+    """Launch up to `count` instances; partial fills are accepted (MinCount 1)."""
+    instance_type, az_name = attempt["instance_type"], attempt["az"]
+    params = {
+        "ImageId": attempt["ami_id"],
+        "InstanceType": instance_type,
+        "MinCount": 1, "MaxCount": count,
+        "Placement": {"AvailabilityZone": az_name},
+        "DryRun": args.dry_run,
+        "TagSpecifications": [{"ResourceType": "instance",
+                               "Tags": [{"Key": "Name", "Value": f"{instance_type}-{az_name}"}]}],
+    }
+    if attempt["subnet_id"]:
+        params["SubnetId"] = attempt["subnet_id"]
+    if args.key_name:
+        params["KeyName"] = args.key_name
+    if args.placement_group:
+        params["Placement"]["GroupName"] = ensure_placement_group(ec2, attempt["region"], args.placement_group)
+    resp = ec2.run_instances(**params)
+    return [i["InstanceId"] for i in resp["Instances"]]
+
+
+def release_ondemand(ec2, instance_id):
+    ec2.terminate_instances(InstanceIds=[instance_id])
+
+
+def run_ondemand(args):
+    run_probe_loop(args, launch_ondemand, release_ondemand, ONDEMAND_RETRY_CODES)
 
 
 # ── Mode 2: Spot Instances ─────────────────────────────────────────────────
 
+def launch_spot(ec2, attempt, args, count=1):
+    instance_type, az_name = attempt["instance_type"], attempt["az"]
+    launch_spec = {
+        "ImageId": attempt["ami_id"],
+        "InstanceType": instance_type,
+        "Placement": {"AvailabilityZone": az_name},
+    }
+    if attempt["subnet_id"]:
+        launch_spec["SubnetId"] = attempt["subnet_id"]
+    if args.key_name:
+        launch_spec["KeyName"] = args.key_name
+    if args.placement_group:
+        launch_spec["Placement"]["GroupName"] = ensure_placement_group(ec2, attempt["region"], args.placement_group)
+
+    params = {
+        "InstanceCount": count,
+        "Type": "one-time",
+        "LaunchSpecification": launch_spec,
+        "DryRun": args.dry_run,
+        "TagSpecifications": [{"ResourceType": "spot-instances-request",
+                               "Tags": [{"Key": "Name", "Value": f"spot-{instance_type}-{az_name}"}]}],
+    }
+    if args.spot_price:
+        params["SpotPrice"] = args.spot_price
+    resp = ec2.request_spot_instances(**params)
+    return wait_spot_fulfillment(ec2, [r["SpotInstanceRequestId"] for r in resp["SpotInstanceRequests"]],
+                                 args.fulfill_timeout)
+
+
+def wait_spot_fulfillment(ec2, request_ids, timeout):
+    """
+    Poll the requests until each has an instance or is closed, for at most `timeout` seconds.
+    Requests still open afterwards are cancelled (terminating any instance that raced the
+    cancel). Returns only the fulfilled request IDs, so open requests never count as held.
+    """
+    deadline = time.time() + timeout
+    fulfilled, pending = [], list(request_ids)
+    while pending:
+        done = set()
+        # Filter rather than SpotInstanceRequestIds: just-created requests may not be visible yet
+        for page in ec2.get_paginator("describe_spot_instance_requests").paginate(
+                Filters=[{"Name": "spot-instance-request-id", "Values": pending}]):
+            for r in page["SpotInstanceRequests"]:
+                if r["State"] == "active" and r.get("InstanceId"):
+                    fulfilled.append(r["SpotInstanceRequestId"])
+                    done.add(r["SpotInstanceRequestId"])
+                elif r["State"] in ("closed", "cancelled", "failed"):
+                    done.add(r["SpotInstanceRequestId"])
+        pending = [i for i in pending if i not in done]
+        if not pending or time.time() >= deadline:
+            break
+        time.sleep(min(SPOT_POLL_INTERVAL, max(deadline - time.time(), 0)))
+    for request_id in pending:
+        release_spot(ec2, request_id)
+    return fulfilled
+
+
+def release_spot(ec2, request_id):
+    """Cancel the spot request and terminate its instance if it was already fulfilled."""
+    ec2.cancel_spot_instance_requests(SpotInstanceRequestIds=[request_id])
+    resp = ec2.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
+    instance_id = resp["SpotInstanceRequests"][0].get("InstanceId")
+    if instance_id:
+        ec2.terminate_instances(InstanceIds=[instance_id])
+
+
 def run_spot(args):
+    state = run_probe_loop(args, launch_spot, release_spot, SPOT_RETRY_CODES)
+    # Wait for fulfillment
+    if state and args.wait:
+        for resource in state["resources"]:
+            request_id = resource["id"]
+            ec2 = get_client("ec2", resource["region"])
+            print("Waiting for spot request fulfillment...")
+            waiter = ec2.get_waiter("spot_instance_request_fulfilled")
+            waiter.wait(SpotInstanceRequestIds=[request_id])
+            resp = ec2.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
+            instance_id = resp["SpotInstanceRequests"][0].get("InstanceId")
+            if instance_id:
+                print(f"Instance launched: {instance_id}")
+
+
+# ── Mode 3: EC2 Fleet (instant) ────────────────────────────────────────────
+
+def create_fleet_template(ec2, args, region, ami_id):
+    """Create a temporary launch template carrying the settings shared by all overrides."""
+    data = {
+        "ImageId": ami_id,
+        "TagSpecifications": [{"ResourceType": "instance",
+                               "Tags": [{"Key": "Name", "Value": f"grab-fleet-{region}"}]}],
+    }
+    if args.key_name:
+        data["KeyName"] = args.key_name
+    if args.placement_group:
+        data["Placement"] = {"GroupName": ensure_placement_group(ec2, region, args.placement_group)}
+    resp = ec2.create_launch_template(LaunchTemplateName=f"grab-instance-{region}-{int(time.time())}",
+                                      LaunchTemplateData=data)
+    return resp["LaunchTemplate"]["LaunchTemplateId"]
+
+
+def fleet_overrides(args, region, pinned_az=None):
+    """One override per instance type × AZ subnet; earlier --instance-type entries get higher priority."""
+    priority = {t: i for i, t in enumerate(args.instance_type.split(','))}
+    overrides = []
+    for attempt in region_attempts(args, region):
+        if pinned_az and f"{region}/{attempt['az']}" != pinned_az:
+            continue
+        override = {"InstanceType": attempt["instance_type"], "Priority": float(priority[attempt["instance_type"]])}
+        if attempt["subnet_id"]:
+            override["SubnetId"] = attempt["subnet_id"]
+        else:
+            override["AvailabilityZone"] = attempt["az"]
+        overrides.append(override)
+    return overrides
+
+
+def request_fleet(ec2, args, template_id, overrides, count):
+    """Fire one instant fleet; returns ([(instance_id, instance_type, az or subnet)], [(error_code, instance_type, az or subnet)])."""
+    params = {
+        "Type": "instant",
+        "LaunchTemplateConfigs": [{"LaunchTemplateSpecification": {"LaunchTemplateId": template_id, "Version": "$Latest"},
+                                   "Overrides": overrides}],
+        "TargetCapacitySpecification": {"TotalTargetCapacity": count, "DefaultTargetCapacityType": args.capacity_type},
+        "OnDemandOptions": {"AllocationStrategy": "prioritized", "SingleAvailabilityZone": args.same_az},
+        "SpotOptions": {"AllocationStrategy": "capacity-optimized-prioritized", "SingleAvailabilityZone": args.same_az},
+    }
+    resp = ec2.create_fleet(**params)
+    launched = []
+    for group in resp.get("Instances", []):
+        override = group.get("LaunchTemplateAndOverrides", {}).get("Overrides", {})
+        az = override.get("AvailabilityZone") or override.get("SubnetId", "?")
+        launched.extend((instance_id, group["InstanceType"], az) for instance_id in group.get("InstanceIds", []))
+    errors = []
+    for err in resp.get("Errors", []):
+        override = err.get("LaunchTemplateAndOverrides", {}).get("Overrides", {})
+        errors.append((err["ErrorCode"], override.get("InstanceType", "?"),
+                       override.get("AvailabilityZone") or override.get("SubnetId", "?")))
+    return launched, errors
+
+
+def run_fleet(args):
     regions = args.region.split(',')
-    instance_types = args.instance_type.split(',')
-    attempt = 0
-    
-    while True:
+    init_launch_contexts(args)
+    contexts = {r: get_launch_context(args, r) for r in regions}
+    regions = [r for r in regions if contexts[r]]
+
+    if args.dry_run:
+        for region in regions:
+            try:
+                get_client("ec2", region).create_launch_template(
+                    LaunchTemplateName="grab-instance-dry-run", DryRun=True,
+                    LaunchTemplateData={"ImageId": contexts[region]["ami_id"]})
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "DryRunOperation":
+                    sys.exit(f"  ERROR [{e.response['Error']['Code']}]: {e.response['Error']['Message']}")
+            print(f"Dry run succeeded in {region}: {len(fleet_overrides(args, region))} overrides.")
+        return
+
+    state = load_state(args, release_ondemand)
+    init_history(args.history_db)
+    lock = threading.Lock()
+    templates = {}
+    try:
         for region in regions:
-            ec2 = boto3.client("ec2", region_name=region)
-            azs = resolve_azs(ec2, args.az, args.include_local_zones)
-            if not azs:
-                print(f"WARNING: Cannot resolve AZ '{args.az}' in region {region}, skipping")
-                continue
-
-            ami_id = args.ami or get_latest_ami(ec2)
-            if not ami_id:
-                print(f"WARNING: Cannot find AMI in {region}, skipping")
-                continue
-
-            for az_name, az_id in azs:
-                for instance_type in instance_types:
-                    attempt += 1
-                    subnet_id = args.subnet or find_subnet_in_az(ec2, az_name)
+            templates[region] = create_fleet_template(get_client("ec2", region), args, region, contexts[region]["ami_id"])
+
+        def fire(region):
+            # Same sizing as probe(): the remainder not already requested by other regions, at least one
+            with lock:
+                remaining = args.count - len(state["resources"])
+                pinned = state["az"] if args.same_az else None
+                if remaining <= 0 or (pinned and not pinned.startswith(f"{region}/")):
+                    return
+                want = max(remaining - state["in_flight"], 1)
+                state["in_flight"] += want
+            ec2 = get_client("ec2", region)
+            subnet_azs = {subnet: az for az, subnet in contexts[region]["subnets"].items()}
+            try:
+                launched, errors = request_fleet(ec2, args, templates[region], fleet_overrides(args, region, pinned), want)
+            except Exception:
+                with lock:
+                    state["in_flight"] -= want
+                raise
+            launched = [(i, t, subnet_azs.get(az, az)) for i, t, az in launched]
+            outcomes = {}
+            for _, instance_type, az in launched:
+                outcomes[("Success", instance_type, az)] = outcomes.get(("Success", instance_type, az), 0) + 1
+            for code, instance_type, az in errors:
+                outcomes.setdefault((code, instance_type, subnet_azs.get(az, az)), 0)
+            for (code, instance_type, az), n in outcomes.items():
+                record_attempt(args.mode, {"region": region, "az": az, "instance_type": instance_type}, code, n)
+            keep = []
+            with lock:
+                state["in_flight"] -= want
+                for instance_id, instance_type, az in launched:
+                    where = f"{region}/{az}"
+                    if len(state["resources"]) >= args.count or (args.same_az and state["az"] not in (None, where)):
+                        continue
+                    if args.same_az:
+                        state["az"] = where
+                    add_resources(args, state, region, az, instance_type, [instance_id])
+                    keep.append(instance_id)
+                total = len(state["resources"])
+            for instance_id, instance_type, az in launched:
+                if instance_id in keep:
+                    log(f"SUCCESS! {instance_id} ({instance_type}) in {region}/{az} [{total}/{args.count}]")
+            extra = [i for i, _, _ in launched if i not in keep]
+            if extra:
+                log(f"  Releasing {len(extra)} extra instance(s) in {region}")
+                ec2.terminate_instances(InstanceIds=extra)
+            if errors:
+                counts = {}
+                for code, _, _ in errors:
+                    counts[code] = counts.get(code, 0) + 1
+                log(f"  {region}: " + ", ".join(f"{code} x{n}" for code, n in counts.items()))
+
+        attempt = 0
+        while len(state["resources"]) < args.count:
+            attempt += 1
+            print(f"\n[Attempt {attempt}] Fleet request for {args.count - len(state['resources'])} {args.capacity_type} "
+                  f"instance(s) across {len(regions)} region(s)...")
+            fatal = []
+            with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+                for future in [pool.submit(fire, r) for r in regions]:
                     try:
-                        print(f"\n[Attempt {attempt}] Requesting Spot {instance_type} in {region}/{az_name}...")
-                        launch_spec = {
-                            "ImageId": ami_id,
-                            "InstanceType": instance_type,
-                            "Placement": {"AvailabilityZone": az_name},
-                        }
-                        if subnet_id:
-                            launch_spec["SubnetId"] = subnet_id
-                        if args.key_name:
-                            launch_spec["KeyName"] = args.key_name
-
-                        params = {
-                            "InstanceCount": 1,
-                            "Type": "one-time",
-                            "LaunchSpecification": launch_spec,
-                            "DryRun": args.dry_run,
-                            "TagSpecifications": [{"ResourceType": "spot-instances-request",
-                                                   "Tags": [{"Key": "Name", "Value": f"spot-{instance_type}-{az_name}"}]}],
-                        }
-                        if args.spot_price:
-                            params["SpotPrice"] = args.spot_price
-
-                        resp = ec2.request_spot_instances(**params)
-                        request_id = resp["SpotInstanceRequests"][0]["SpotInstanceRequestId"]
-                        print(f"SUCCESS! Spot request: {request_id} in {region}")
-                        
-                        # Wait for fulfillment
-                        if not args.dry_run and args.wait:
-                            print("Waiting for spot request fulfillment...")
-                            waiter = ec2.get_waiter("spot_instance_request_fulfilled")
-                            waiter.wait(SpotInstanceRequestIds=[request_id])
-                            resp = ec2.describe_spot_instance_requests(SpotInstanceRequestIds=[request_id])
-                            instance_id = resp["SpotInstanceRequests"][0].get("InstanceId")
-                            if instance_id:
-                                print(f"Instance launched: {instance_id}")
-                        return
+                        future.result()
                     except ClientError as e:
                         code = e.response["Error"]["Code"]
                         msg = e.response["Error"]["Message"]
-                        if code == "DryRunOperation":
-                            print("Dry run succeeded - request would have been accepted.")
-                            return
-                        elif code in ("InsufficientInstanceCapacity", "SpotMaxPriceTooLow", "Unsupported", "InvalidParameterValue"):
-                            print(f"  {code}: {msg}")
+                        if code not in ONDEMAND_RETRY_CODES + SPOT_RETRY_CODES:
+                            fatal.append(f"  ERROR [{code}]: {msg}")
                         else:
-                            sys.exit(f"  ERROR [{code}]: {msg}")
+                            log(f"  {code}: {msg}")
+            if fatal:
+                # Let the other regions finish first so everything they acquired is reported
+                report_held_on_error(state)
+                sys.exit(fatal[0])
+            print(f"  Acquired {len(state['resources'])}/{args.count}")
+            if len(state["resources"]) >= args.count:
+                break
+            check_deadline(args, state, release_ondemand)
+            if args.max_retries and attempt >= args.max_retries:
+                sys.exit(f"\nMax retries ({args.max_retries}) reached.")
+            print(f"  Retrying all regions in {args.interval}s...")
+            time.sleep(args.interval)
+    finally:
+        for region, template_id in templates.items():
+            get_client("ec2", region).delete_launch_template(LaunchTemplateId=template_id)
 
-                    if args.max_retries and attempt >= args.max_retries:
-                        sys.exit(f"\nMax retries ({args.max_retries}) reached.")
+    print_resources(state)
 
-        print(f"  Retrying all regions in {args.interval}s...")
-        time.sleep(args.interval)
 
+# ── Reservation offering search (Capacity Blocks / Training Plans) ───────
 
-# ── Mode 3: EC2 Capacity Blocks ────────────────────────────────────────────
+CB_RETRY_CODES = ("InsufficientInstanceCapacity", "Unavailable", "InvalidParameterValue")
+TP_RETRY_CODES = ("ResourceLimitExceeded", "InvalidParameterValue")
 
-def run_capacity_block(args):
-    regions = args.region.split(',')
-    instance_types = args.instance_type.split(',')
-    instance_count = args.instance_count
-    duration_hours = args.duration_hours
-    now = datetime.now(timezone.utc)
-    attempt = 0
 
-    while True:
-        for region in regions:
-            attempt += 1
-            ec2 = boto3.client("ec2", region_name=region)
-            azs = resolve_azs(ec2, args.az, args.include_local_zones)
-            if not azs:
-                print(f"WARNING: Cannot resolve AZ '{args.az}' in region {region}, skipping")
-                continue
-            az_names = {n for n, _ in azs}
-
-            all_offerings = []
-            for instance_type in instance_types:
-                search_params = {
-                    "InstanceType": instance_type,
-                    "InstanceCount": instance_count,
-                    "CapacityDurationHours": duration_hours,
-                    "StartDateRange": now,
-                    "EndDateRange": now + timedelta(days=7),
-                }
-
-                print(f"\n[Attempt {attempt}] Searching Capacity Block in {region}: {instance_count}x {instance_type}, {duration_hours}h...")
-                try:
-                    resp = ec2.describe_capacity_block_offerings(**search_params)
-                    offerings = resp.get("CapacityBlockOfferings", [])
-                    offerings = [o for o in offerings if o["AvailabilityZone"] in az_names]
-                    if offerings:
-                        print(f"  Found {len(offerings)} offering(s) for {instance_type}")
-                        all_offerings.extend(offerings)
-                    else:
-                        print(f"  No offerings for {instance_type}")
-                except ClientError as e:
-                    code = e.response["Error"]["Code"]
-                    msg = e.response["Error"]["Message"]
-                    print(f"  ERROR [{code}]: {msg}")
-                    if code not in ("InsufficientInstanceCapacity", "Unavailable", "InvalidParameterValue"):
-                        sys.exit(1)
-
-            if not all_offerings:
-                print(f"  No offerings in {region}")
-                continue
-
-            print(f"\nFound {len(all_offerings)} total offering(s) in {region}:")
-            for i, o in enumerate(all_offerings):
-                print(f"  [{i}] ID: {o['CapacityBlockOfferingId']}")
-                print(f"      Type: {o['InstanceType']}, AZ: {o['AvailabilityZone']}, Instances: {o['InstanceCount']}")
-                print(f"      Start: {o['StartDate']}, End: {o['EndDate']}")
-                print(f"      Duration: {o.get('CapacityBlockDurationHours', '?')}h, Fee: ${o.get('UpfrontFee', '?')} {o.get('CurrencyCode', '')}")
-
-            if args.dry_run:
-                print("\nDry run - not purchasing.")
-                return
+def search_offerings(tasks, search, retry_codes):
+    """Run search(region, instance_type, duration) for every task concurrently and merge the offerings."""
+    offerings, fatal = [], []
 
-            if args.auto_purchase:
-                chosen = all_offerings[0]
-            else:
-                idx = input(f"\nSelect offering [0-{len(all_offerings)-1}] or 'q' to quit: ").strip()
-                if idx.lower() == "q":
-                    return
-                chosen = all_offerings[int(idx)]
+    def run(task):
+        region, instance_type, duration = task
+        try:
+            found = search(*task)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            log(f"  {region} {instance_type} {duration}h ERROR [{code}]: {e.response['Error']['Message']}")
+            if code not in retry_codes:
+                fatal.append(code)
+            return []
+        log(f"  {region} {instance_type} {duration}h: {len(found)} offering(s)")
+        return found
 
-            offering_id = chosen["CapacityBlockOfferingId"]
-            print(f"\nPurchasing Capacity Block {offering_id} in {region}...")
-            try:
-                purchase_resp = ec2.purchase_capacity_block(
-                    CapacityBlockOfferingId=offering_id,
-                    InstancePlatform="Linux/UNIX",
-                )
-                cb = purchase_resp.get("CapacityReservation", {})
-                cb_id = cb.get("CapacityReservationId", "N/A")
-                cb_state = cb.get("State", "N/A")
-                print(f"SUCCESS! Capacity Block purchased in {region}.")
-                print(f"  ID: {cb_id}")
-                print(f"  State: {cb_state}")
-                return
-            except ClientError as e:
-                code = e.response["Error"]["Code"]
-                msg = e.response["Error"]["Message"]
-                print(f"  ERROR [{code}]: {msg}")
-                if code not in ("InsufficientInstanceCapacity", "Unavailable", "InvalidParameterValue"):
-                    sys.exit(1)
+    with ThreadPoolExecutor(max_workers=min(len(tasks), 32) or 1) as pool:
+        for found in pool.map(run, tasks):
+            offerings.extend(found)
+    if fatal:
+        sys.exit(1)
+    return offerings
 
-            if args.max_retries and attempt >= args.max_retries:
-                sys.exit(f"\nMax retries ({args.max_retries}) reached.")
-
-        print(f"  Retrying all regions in {args.interval}s...")
-        time.sleep(args.interval)
-
-
-# ── Mode 4: SageMaker Training Plans ───────────────────────────────────────
 
-def run_training_plan(args):
+def rank_offerings(offerings, args):
+    """Apply --start-within / --max-price and sort by --policy (price per instance-hour or start time)."""
+    now = datetime.now(timezone.utc)
+    if args.start_within:
+        offerings = [o for o in offerings if o["start"] <= now + timedelta(hours=args.start_within)]
+    if args.max_price:
+        offerings = [o for o in offerings if o["unit_price"] <= args.max_price]
+    if args.policy == "earliest":
+        return sorted(offerings, key=lambda o: (o["start"], o["unit_price"]))
+    return sorted(offerings, key=lambda o: (o["unit_price"], o["start"]))
+
+
+def print_offerings(offerings):
+    print(f"\n{'#':>3} {'Region':<15} {'AZ':<16} {'Type':<18} {'Count':>5} {'Hours':>6} {'Start (UTC)':<17} "
+          f"{'Upfront':>12} {'$/inst-hour':>11}")
+    for i, o in enumerate(offerings):
+        print(f"{i:>3} {o['region']:<15} {o['az']:<16} {o['instance_type']:<18} {o['count']:>5} {o['duration']:>6} "
+              f"{o['start'].strftime('%Y-%m-%d %H:%M'):<17} {o['fee']:>12,.2f} {o['unit_price']:>11.3f}")
+
+
+def choose_and_purchase(offerings, args, purchase):
+    """
+    Purchase the best-ranked offering, falling back to the next one if it was taken meanwhile.
+    Without --auto-purchase the user picks one interactively. Returns True once purchased.
+    """
+    if args.dry_run:
+        print("\nDry run - not purchasing.")
+        return True
+    if args.auto_purchase:
+        candidates = offerings
+    else:
+        idx = input(f"\nSelect offering [0-{len(offerings)-1}] or 'q' to quit: ").strip()
+        if idx.lower() == "q":
+            return True
+        candidates = [offerings[int(idx)]]
+    for chosen in candidates:
+        try:
+            purchase(chosen)
+            return True
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            print(f"  ERROR [{code}]: {e.response['Error']['Message']}")
+            if code not in args.retry_codes:
+                sys.exit(1)
+    return False
+
+
+def run_offering_search(args, search, purchase, label):
+    """Search all regions × types × durations in parallel each round until an offering is purchased."""
     regions = args.region.split(',')
     instance_types = args.instance_type.split(',')
-    instance_count = args.instance_count
-    duration_hours = args.duration_hours
-    target = args.sm_target
-    now = datetime.now(timezone.utc)
+    durations = [int(d) for d in str(args.duration_hours).split(',')]
+    tasks = list(itertools.product(regions, instance_types, durations))
     attempt = 0
 
     while True:
-        for region in regions:
-            attempt += 1
-            sm = boto3.client("sagemaker", region_name=region)
-
-            all_offerings = []
-            for instance_type in instance_types:
-                sm_instance_type = instance_type if instance_type.startswith("ml.") else f"ml.{instance_type}"
-                search_params = {
-                    "InstanceType": sm_instance_type,
-                    "InstanceCount": instance_count,
-                    "DurationHours": duration_hours,
-                    "TargetResources": [target],
-                    "StartTimeAfter": now,
-                    "EndTimeBefore": now + timedelta(weeks=8),
-                }
-
-                print(f"\n[Attempt {attempt}] Searching SageMaker Training Plan in {region}: {instance_count}x {sm_instance_type}, {duration_hours}h, target={target}...")
-                try:
-                    resp = sm.search_training_plan_offerings(**search_params)
-                    offerings = resp.get("TrainingPlanOfferings", [])
-                    if offerings:
-                        print(f"  Found {len(offerings)} offering(s) for {sm_instance_type}")
-                        all_offerings.extend(offerings)
-                    else:
-                        print(f"  No offerings for {sm_instance_type}")
-                except ClientError as e:
-                    code = e.response["Error"]["Code"]
-                    msg = e.response["Error"]["Message"]
-                    print(f"  ERROR [{code}]: {msg}")
-                    if code not in ("ResourceLimitExceeded", "InvalidParameterValue"):
-                        sys.exit(1)
-
-            if not all_offerings:
-                print(f"  No offerings in {region}")
-                continue
-
-            print(f"\nFound {len(all_offerings)} total offering(s) in {region}:")
-            for i, o in enumerate(all_offerings):
-                print(f"  [{i}] ID: {o['TrainingPlanOfferingId']}")
-                print(f"      Duration: {o.get('DurationHours', '?')}h, Fee: ${o.get('UpfrontFee', '?')} {o.get('CurrencyCode', '')}")
-                print(f"      Target: {o.get('TargetResources', [])}")
-                for rc in o.get("ReservedCapacityOfferings", []):
-                    print(f"      -> {rc.get('InstanceType')} x{rc.get('InstanceCount')} in {rc.get('AvailabilityZone', 'N/A')}, "
-                          f"{rc.get('DurationHours', '?')}h, start={rc.get('StartDate', 'N/A')}")
-
-            if args.dry_run:
-                print("\nDry run - not purchasing.")
+        attempt += 1
+        print(f"\n[Attempt {attempt}] Searching {label}: {len(regions)} region(s) × {len(instance_types)} type(s) × "
+              f"{len(durations)} duration(s), {args.instance_count} instance(s)...")
+        offerings = rank_offerings(search_offerings(tasks, search, args.retry_codes), args)
+        if offerings:
+            print_offerings(offerings)
+            if choose_and_purchase(offerings, args, purchase):
                 return
+        else:
+            print("  No matching offerings")
 
-            if args.auto_purchase:
-                chosen = all_offerings[0]
-            else:
-                idx = input(f"\nSelect offering [0-{len(all_offerings)-1}] or 'q' to quit: ").strip()
-                if idx.lower() == "q":
-                    return
-                chosen = all_offerings[int(idx)]
+        if args.max_retries and attempt >= args.max_retries:
+            sys.exit(f"\nMax retries ({args.max_retries}) reached.")
+        print(f"  Retrying all regions in {args.interval}s...")
+        time.sleep(args.interval)
 
-            offering_id = chosen["TrainingPlanOfferingId"]
-            plan_name = args.plan_name or f"plan-{int(now.timestamp())}"
-            print(f"\nCreating Training Plan '{plan_name}' from offering {offering_id} in {region}...")
-            try:
-                create_resp = sm.create_training_plan(
-                    TrainingPlanName=plan_name,
-                    TrainingPlanOfferingId=offering_id,
-                )
-                print(f"SUCCESS! Training Plan created in {region}.")
-                print(f"  ARN: {create_resp['TrainingPlanArn']}")
-                return
-            except ClientError as e:
-                code = e.response["Error"]["Code"]
-                msg = e.response["Error"]["Message"]
-                print(f"  ERROR [{code}]: {msg}")
-                if code not in ("ResourceLimitExceeded", "InvalidParameterValue"):
-                    sys.exit(1)
 
-            if args.max_retries and attempt >= args.max_retries:
-                sys.exit(f"\nMax retries ({args.max_retries}) reached.")
+# ── Mode 4: EC2 Capacity Blocks ────────────────────────────────────────────
 
-        print(f"  Retrying all regions in {args.interval}s...")
-        time.sleep(args.interval)
+def run_capacity_block(args):
+    now = datetime.now(timezone.utc)
+    window = timedelta(days=args.search_days or 7)
+    args.retry_codes = CB_RETRY_CODES
+    az_names = {}
+
+    def allowed_azs(region):
+        if region not in az_names:
+            az_names[region] = {n for n, _ in resolve_azs(get_client("ec2", region), args.az, args.include_local_zones)}
+        return az_names[region]
+
+    def search(region, instance_type, duration):
+        ec2 = get_client("ec2", region)
+        params = {
+            "InstanceType": instance_type,
+            "InstanceCount": args.instance_count,
+            "CapacityDurationHours": duration,
+            "StartDateRange": now,
+            "EndDateRange": now + window,
+        }
+        found = []
+        while True:
+            resp = ec2.describe_capacity_block_offerings(**params)
+            for o in resp.get("CapacityBlockOfferings", []):
+                if o["AvailabilityZone"] not in allowed_azs(region):
+                    continue
+                hours = o.get("CapacityBlockDurationHours", duration)
+                fee = float(o.get("UpfrontFee", 0))
+                found.append({"region": region, "id": o["CapacityBlockOfferingId"], "instance_type": o["InstanceType"],
+                              "az": o["AvailabilityZone"], "count": o["InstanceCount"], "duration": hours,
+                              "start": o["StartDate"], "fee": fee, "currency": o.get("CurrencyCode", ""),
+                              "unit_price": fee / hours / o["InstanceCount"]})
+            if not resp.get("NextToken"):
+                return found
+            params["NextToken"] = resp["NextToken"]
+
+    def purchase(chosen):
+        print(f"\nPurchasing Capacity Block {chosen['id']} in {chosen['region']}/{chosen['az']}...")
+        purchase_resp = get_client("ec2", chosen["region"]).purchase_capacity_block(
+            CapacityBlockOfferingId=chosen["id"],
+            InstancePlatform="Linux/UNIX",
+        )
+        cb = purchase_resp.get("CapacityReservation", {})
+        print(f"SUCCESS! Capacity Block purchased in {chosen['region']}.")
+        print(f"  ID: {cb.get('CapacityReservationId', 'N/A')}")
+        print(f"  State: {cb.get('State', 'N/A')}")
+
+    run_offering_search(args, search, purchase, "Capacity Blocks")
+
+
+# ── Mode 5: SageMaker Training Plans ───────────────────────────────────────
+
+def run_training_plan(args):
+    now = datetime.now(timezone.utc)
+    window = timedelta(days=args.search_days or 56)
+    args.retry_codes = TP_RETRY_CODES
+
+    def search(region, instance_type, duration):
+        sm = get_client("sagemaker", region)
+        sm_instance_type = instance_type if instance_type.startswith("ml.") else f"ml.{instance_type}"
+        resp = sm.search_training_plan_offerings(
+            InstanceType=sm_instance_type,
+            InstanceCount=args.instance_count,
+            DurationHours=duration,
+            TargetResources=[args.sm_target],
+            StartTimeAfter=now,
+            EndTimeBefore=now + window,
+        )
+        found = []
+        for o in resp.get("TrainingPlanOfferings", []):
+            capacities = o.get("ReservedCapacityOfferings", [])
+            hours = o.get("DurationHours", duration)
+            count = sum(rc.get("InstanceCount", 0) for rc in capacities) or args.instance_count
+            fee = float(o.get("UpfrontFee", 0))
+            found.append({"region": region, "id": o["TrainingPlanOfferingId"], "instance_type": sm_instance_type,
+                          "az": ",".join(sorted({rc.get("AvailabilityZone", "N/A") for rc in capacities})) or "N/A",
+                          "count": count, "duration": hours,
+                          "start": min((rc["StartDate"] for rc in capacities if rc.get("StartDate")), default=now),
+                          "fee": fee, "currency": o.get("CurrencyCode", ""), "unit_price": fee / hours / count})
+        return found
+
+    def purchase(chosen):
+        plan_name = args.plan_name or f"plan-{int(now.timestamp())}"
+        print(f"\nCreating Training Plan '{plan_name}' from offering {chosen['id']} in {chosen['region']}...")
+        create_resp = get_client("sagemaker", chosen["region"]).create_training_plan(
+            TrainingPlanName=plan_name,
+            TrainingPlanOfferingId=chosen["id"],
+        )
+        print(f"SUCCESS! Training Plan created in {chosen['region']}.")
+        print(f"  ARN: {create_resp['TrainingPlanArn']}")
+
+    run_offering_search(args, search, purchase, "SageMaker Training Plans")
 
 
 # ── CLI ─────────────────────────────────────────────────────────────────────
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Grab GPU instances via On-Demand, Spot, Capacity Blocks, or SageMaker Training Plans",
+        description="Grab GPU instances via On-Demand, Spot, EC2 Fleet, Capacity Blocks, or SageMaker Training Plans",
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
@@ -405,35 +1068,82 @@ Examples:
   # On-Demand with multiple regions
   %(prog)s ondemand --region us-east-1,us-west-2,eu-west-1 --instance-type p5e.48xlarge
 
+  # 16 nodes in one AZ and cluster placement group, resumable, give up after 2 hours
+  %(prog)s --region us-east-1 --instance-type p5.48xlarge ondemand --count 16 --same-az \\
+      --placement-group train-pg --deadline 120 --state-file p5-train.json
+
+  # Spot across regions, best placement scores first, backing off up to 10 minutes per AZ
+  %(prog)s --region us-east-1,us-west-2 --instance-type p5.48xlarge spot --placement-scores --max-backoff 600
+
+  # Launch success by hour of day from the attempt history
+  %(prog)s report --days 14
+
   # Spot instance request
   %(prog)s spot --region us-east-1 --az use1-az5 --wait
 
   # Spot with multiple regions and max price
   %(prog)s spot --region us-east-1,us-west-2 --instance-type p5.48xlarge --spot-price 10.0
 
+  # Instant EC2 Fleet across types, AZs and regions until 8 instances are running
+  %(prog)s --region us-east-1,us-west-2 --instance-type p5.48xlarge,p5e.48xlarge fleet --count 8
+
   # Search & purchase EC2 Capacity Block
   %(prog)s capacity-block --region us-east-1 --az use1-az5 --duration 24
 
+  # Buy the cheapest Capacity Block starting within 48h across regions, types and durations
+  %(prog)s --region us-east-1,us-east-2,us-west-2 --instance-type p5.48xlarge,p5e.48xlarge \\
+      capacity-block --duration 24,48,72 --auto-purchase --policy cheapest --start-within 48
+
   # Search & purchase SageMaker Training Plan across regions
   %(prog)s training-plan --region us-east-1,eu-west-1 --instance-type p5.48xlarge --duration 48 --sm-target training-job
 """,
     )
     # Common args
-    parser.add_argument("--region", required=True, help="AWS region(s), comma-separated (e.g. us-east-1 or us-east-1,us-west-2)")
+    parser.add_argument("--region", help="AWS region(s), comma-separated (e.g. us-east-1 or us-east-1,us-west-2)")
     parser.add_argument("--az", default=None, help="AZ name or ID, comma-separated (e.g. us-east-1e or use1-az5,use1-az6). If omitted, tries all AZs")
     parser.add_argument("--instance-type", default="p5.4xlarge", help="EC2 instance type(s), comma-separated (e.g. p4d.24xlarge,p5.48xlarge)")
     parser.add_argument("--interval", type=int, default=10, help="Retry interval seconds (default: 10)")
     parser.add_argument("--max-retries", type=int, default=0, help="Max retries, 0=unlimited")
     parser.add_argument("--dry-run", action="store_true", help="Dry run / search only")
     parser.add_argument("--include-local-zones", action="store_true", help="Include Local Zones in search")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent launch attempts in flight (default: 16)")
+    parser.add_argument("--history-db", default="grab_history.db",
+                        help="SQLite file recording every attempt's outcome (default: grab_history.db)")
+    parser.add_argument("--context-ttl", type=int, default=900,
+                        help="Seconds between background refreshes of cached AZs/AMI/subnets, 0=never (default: 900)")
 
     sub = parser.add_subparsers(dest="mode", required=True)
 
+    def add_target_args(p):
+        p.add_argument("--count", type=int, default=1, help="Target number of instances (default: 1)")
+        p.add_argument("--same-az", action="store_true", help="Keep all instances in the first AZ that gets capacity")
+        p.add_argument("--placement-group", help="Cluster placement group name (created per region if missing)")
+        p.add_argument("--deadline", type=float, default=0,
+                       help="Minutes to reach --count before releasing partial capacity, 0=no deadline")
+        p.add_argument("--keep-partial", action="store_true", help="Keep partial capacity when the deadline passes")
+        p.add_argument("--state-file", help="JSON file tracking acquired resources; resumes on restart without double-launching")
+
+    def add_offering_args(p, default_days):
+        p.add_argument("--auto-purchase", action="store_true", help="Auto-purchase the best offering under --policy")
+        p.add_argument("--policy", choices=["cheapest", "earliest"], default="cheapest",
+                       help="Ranking: lowest price per instance-hour or earliest start (default: cheapest)")
+        p.add_argument("--start-within", type=float, help="Only offerings starting within N hours")
+        p.add_argument("--max-price", type=float, help="Only offerings at or below this price per instance-hour")
+        p.add_argument("--search-days", type=int, help=f"Days ahead to search (default: {default_days})")
+
+    def add_schedule_args(p):
+        p.add_argument("--max-backoff", type=int, default=300,
+                       help="Max seconds between attempts on an AZ/type after repeated capacity errors (default: 300)")
+        p.add_argument("--placement-scores", action="store_true",
+                       help="Try AZs with higher spot placement scores first")
+
     # On-Demand
     p_od = sub.add_parser("ondemand", help="On-Demand instance with retry loop")
     p_od.add_argument("--ami", help="AMI ID (auto-detect if omitted)")
     p_od.add_argument("--subnet", help="Subnet ID (auto-detect if omitted)")
     p_od.add_argument("--key-name", help="EC2 key pair name")
+    add_target_args(p_od)
+    add_schedule_args(p_od)
 
     # Spot
     p_spot = sub.add_parser("spot", help="Spot instance request with retry loop")
@@ -442,28 +1152,53 @@ Examples:
     p_spot.add_argument("--key-name", help="EC2 key pair name")
     p_spot.add_argument("--spot-price", help="Max spot price (default: on-demand price)")
     p_spot.add_argument("--wait", action="store_true", help="Wait for spot request fulfillment")
+    p_spot.add_argument("--fulfill-timeout", type=int, default=60,
+                        help="Seconds to wait for a spot request to be fulfilled before cancelling it and retrying (default: 60)")
+    add_target_args(p_spot)
+    add_schedule_args(p_spot)
+
+    # EC2 Fleet
+    p_fleet = sub.add_parser("fleet", help="Instant EC2 Fleet over all types/AZs per region, accumulating to a target count")
+    p_fleet.add_argument("--ami", help="AMI ID (auto-detect if omitted)")
+    p_fleet.add_argument("--subnet", help="Subnet ID (auto-detect per AZ if omitted)")
+    p_fleet.add_argument("--key-name", help="EC2 key pair name")
+    p_fleet.add_argument("--capacity-type", choices=["on-demand", "spot"], default="on-demand",
+                         help="Fleet capacity type (default: on-demand)")
+    add_target_args(p_fleet)
 
     # Capacity Block
     p_cb = sub.add_parser("capacity-block", help="EC2 Capacity Block reservation")
     p_cb.add_argument("--instance-count", type=int, default=1, help="Number of instances (default: 1)")
-    p_cb.add_argument("--duration", type=int, default=24, dest="duration_hours", help="Duration in hours (default: 24)")
-    p_cb.add_argument("--auto-purchase", action="store_true", help="Auto-purchase first available offering")
+    p_cb.add_argument("--duration", default="24", dest="duration_hours",
+                      help="Duration(s) in hours, comma-separated (default: 24)")
+    add_offering_args(p_cb, 7)
 
     # SageMaker Training Plan
     p_tp = sub.add_parser("training-plan", help="SageMaker Training Plan reservation")
     p_tp.add_argument("--instance-count", type=int, default=1, help="Number of instances (default: 1)")
-    p_tp.add_argument("--duration", type=int, default=24, dest="duration_hours", help="Duration in hours (default: 24)")
+    p_tp.add_argument("--duration", default="24", dest="duration_hours",
+                      help="Duration(s) in hours, comma-separated (default: 24)")
     p_tp.add_argument("--sm-target", choices=["training-job", "hyperpod-cluster"], default="training-job",
                        help="Target resource type (default: training-job)")
     p_tp.add_argument("--plan-name", help="Training plan name (auto-generated if omitted)")
-    p_tp.add_argument("--auto-purchase", action="store_true", help="Auto-purchase first available offering")
+    add_offering_args(p_tp, 56)
+
+    # Attempt history report
+    p_report = sub.add_parser("report", help="Report launch success by hour of day from --history-db")
+    p_report.add_argument("--days", type=int, default=7, help="Days of history to include (default: 7)")
 
     args = parser.parse_args()
+    if args.mode != "report" and not args.region:
+        parser.error("--region is required")
 
-    if args.mode == "ondemand":
+    if args.mode == "report":
+        run_report(args)
+    elif args.mode == "ondemand":
         run_ondemand(args)
     elif args.mode == "spot":
         run_spot(args)
+    elif args.mode == "fleet":
+        run_fleet(args)
     elif args.mode == "capacity-block":
         run_capacity_block(args)
     elif args.mode == "training-plan":
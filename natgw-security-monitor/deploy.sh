@@ -4,7 +4,7 @@
 
 # 检查参数
 if [ $# -lt 5 ]; then
-    echo "用法: $0 <stack-name> <nat-gateway-id> <email> <region> <threshold-bytesmin>"
+    echo "用法: $0 <stack-name> <nat-gateway-id> <email> <region> <threshold-bytesmin> [streaming-detection true|false]"
     echo "示例: $0 natgw-monitor nat-12345678 user@example.com us-east-1 100000"
     exit 1
 fi
@@ -14,6 +14,7 @@ NAT_GW_ID=$2
 EMAIL=$3
 REGION=$4
 THRESHOLD=$5
+STREAMING=${6:-false}
 
 echo "开始部署 NAT Gateway Security Monitor..."
 echo "Stack Name: $STACK_NAME"
@@ -21,6 +22,7 @@ echo "NAT Gateway ID: $NAT_GW_ID"
 echo "Email: $EMAIL"
 echo "Region: $REGION"
 echo "Threshold: $THRESHOLD MB/s"
+echo "Streaming Detection: $STREAMING"
 
 # 部署CloudFormation堆栈
 aws cloudformation deploy \
@@ -32,6 +34,7 @@ aws cloudformation deploy \
         OutDataAlertThreshold=$THRESHOLD \
         NotifyEmail=$EMAIL \
         LogsRetainDays=7 \
+        StreamingDetection=$STREAMING \
     --capabilities CAPABILITY_IAM \
     --region $REGION
 
@@ -0,0 +1,95 @@
+# pip install dnspython maxminddb boto3
+# 新ip判断（batch_findip_in_ddb + fill_ip_data 中的行筛选）性能测试，不访问AWS：
+# 构造10万个目标ip的查询窗口，用内存中的假DynamoDB返回结果，对比原来的列表查找与字典关联
+# python ip-join-benchmark.py [ip数量] [已登记比例] [UnprocessedKeys比例]
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('STACK_NAME', 'natgw-monitor')
+os.environ.setdefault('SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:123456789012:natgw-monitor-notify')
+os.environ.setdefault('REFRESH_INTERVAL', '10')
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+
+import lambda_function
+
+class FakeDynamoDB:
+    '''
+    按 batch_get_item 的格式返回已登记的ip，返回顺序打乱
+    typed=True 时模拟 client 的格式，并把首次请求的部分key作为 UnprocessedKeys 返回
+    '''
+    def __init__(self, known, typed=False, unprocessed_ratio=0.0):
+        self.known = known
+        self.typed = typed
+        self.unprocessed_ratio = unprocessed_ratio
+        self.seen = set()
+
+    def batch_get_item(self, RequestItems):
+        table, request = next(iter(RequestItems.items()))
+        ips = [key['ip']['S'] if self.typed else key['ip'] for key in request['Keys']]
+        unprocessed = [ip for ip in ips if ip not in self.seen and random.random() < self.unprocessed_ratio]
+        self.seen.update(ips)
+        items = [self.known[ip] for ip in ips if ip in self.known and ip not in unprocessed]
+        if self.typed:
+            items = [{k: {'S': v} for k, v in item.items()} for item in items]
+        random.shuffle(items)
+        response = {'Responses': {table: items}, 'UnprocessedKeys': {}}
+        if unprocessed:
+            response['UnprocessedKeys'] = {table: dict(request, Keys=[{'ip': {'S': ip}} for ip in unprocessed])}
+        return response
+
+legacy_ddb = None
+
+def legacy_findip(ip_list):
+    '''原实现：在每批返回列表中用 next() 线性查找，返回列表'''
+    non_existing_ips = []
+    for i in range(0, len(ip_list), 100):
+        batch_ips = ip_list[i:i+100]
+        response = legacy_ddb.batch_get_item(
+            RequestItems={lambda_function.table_name: {'Keys': [{'ip': ip} for ip in batch_ips]}})
+        returned_items = response.get('Responses', {}).get(lambda_function.table_name, [])
+        returned_ips = {item['ip'] for item in returned_items}
+        for ip in batch_ips:
+            if ip in returned_ips:
+                item = next(item for item in returned_items if item['ip'] == ip)
+                if item.get('action', '').startswith('slient-'):
+                    continue
+            non_existing_ips.append(ip)
+    return non_existing_ips
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    known_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.9
+    unprocessed_ratio = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    random.seed(1)
+    ips = list({f"{random.randint(1, 223)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(1, 254)}"
+                for _ in range(count * 2)})[:count]
+    rows = [{'dstaddr': ip, 'total_bytes': str(random.randint(40, 10**7)), 'connection_count': str(random.randint(1, 500))}
+            for ip in ips]
+    known = {ip: {'ip': ip, 'action': random.choice(['slient-by-insert', 'slient-by-insert', 'alert'])}
+             for ip in random.sample(ips, int(count * known_ratio))}
+    global legacy_ddb
+    legacy_ddb = FakeDynamoDB(known)
+    # 模拟限流：部分key首次返回为 UnprocessedKeys，需要重试
+    lambda_function.ddb_client = FakeDynamoDB(known, typed=True, unprocessed_ratio=unprocessed_ratio)
+    print(f"{count} 个ip，已登记 {len(known)} 个")
+
+    ip_list = [item['dstaddr'] for item in rows]
+    start = time.perf_counter()
+    legacy = legacy_findip(ip_list)
+    legacy_rows = [item for item in rows if item['dstaddr'] in legacy]
+    legacy_time = time.perf_counter() - start
+    print(f"列表查找: {legacy_time:.3f}s，新ip {len(legacy_rows)} 个")
+
+    start = time.perf_counter()
+    new_ips = lambda_function.batch_findip_in_ddb(ip_list)
+    new_rows = [item for item in rows if item['dstaddr'] in new_ips]
+    join_time = time.perf_counter() - start
+    print(f"字典关联: {join_time:.3f}s，新ip {len(new_rows)} 个")
+
+    assert [item['dstaddr'] for item in legacy_rows] == [item['dstaddr'] for item in new_rows]
+    print(f"结果一致，加速 {legacy_time / join_time:.1f} 倍")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,25 @@
 # pip install dnspython maxminddb boto3
+import argparse
+import codecs
 import concurrent.futures
+import csv
+import gzip
+import itertools
 import dns.resolver
 import dns.reversename
 import maxminddb
 import boto3
-from datetime import datetime, timezone
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote_plus, urlparse
 import time
 import json
+import random
 import re
 import os
+import threading
+from collections import OrderedDict
 from botocore.exceptions import ClientError
 
 # 环境变量
@@ -18,34 +29,114 @@ REFRESH_INTERVAL = int(os.environ['REFRESH_INTERVAL'])
 AWS_REGION = os.environ['AWS_REGION']
 if not STACK_NAME or not SNS_TOPIC_ARN or not REFRESH_INTERVAL or not AWS_REGION:
     raise ValueError("environment variable is required")
+# 并发查询DynamoDB的线程数，以及UnprocessedKeys的最大重试次数
+DDB_WORKERS = int(os.environ.get('DDB_WORKERS', '8'))
+DDB_MAX_RETRIES = 5
+# 容器复用时跨调用保留的缓存：已静默ip、反向解析结果（条目数上限和过期秒数）
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', '200000'))
+KNOWN_IP_TTL = int(os.environ.get('KNOWN_IP_TTL', '3600'))
+PTR_TTL = int(os.environ.get('PTR_TTL', '86400'))
+MMDB_ASN = 'data/GeoLite2-ASN.mmdb'
+MMDB_COUNTRY = 'data/GeoLite2-Country.mmdb'
+# 查询结果按块处理的行数
+RESULT_CHUNK_SIZE = int(os.environ.get('RESULT_CHUNK_SIZE', '5000'))
+# 实时检测（S3事件）按dstaddr汇总流量的滑动窗口分钟数
+STREAM_WINDOW_MINUTES = int(os.environ.get('STREAM_WINDOW_MINUTES', str(REFRESH_INTERVAL)))
+# 文本flowlog字段位置，与yaml中NatGatewayFlowLog的LogFormat一致
+FLOW_DSTADDR, FLOW_BYTES, FLOW_START, FLOW_END, FLOW_ACTION = 4, 9, 10, 11, 12
+PRIVATE_DST = re.compile(rb'^(10\.|172\.(1[6-9]|2[0-9]|3[01])\.|192\.168\.|127\.|169\.254\.)')
+SHANGHAI = timezone(timedelta(hours=8))
 
 # 使用boto3 进行 athena saved query 查询
 table_name = STACK_NAME + '-table'
 athena_db = STACK_NAME + '-db'
 athena_workgroup = STACK_NAME + '-workgroup'
 
-ddb_resource = boto3.resource('dynamodb', region_name=AWS_REGION)
+# client 是线程安全的，并发读写都使用 client；限流时由 botocore 自动退避重试
+ddb_client = boto3.client('dynamodb', region_name=AWS_REGION,
+                          config=Config(retries={'mode': 'standard', 'max_attempts': 10}))
+ddb_serializer = TypeSerializer()
 athena_client = boto3.client('athena', region_name=AWS_REGION)
 sns_client = boto3.client('sns', region_name=AWS_REGION)
+s3_client = boto3.client('s3', region_name=AWS_REGION)
+
+class TTLCache:
+    """
+    有界LRU缓存，条目超过ttl秒后失效，超过maxsize时淘汰最久未使用的条目
+    放在模块级别，Lambda容器复用时跨调用保留
+    """
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+# 已确认静默（slient-）的ip，以及反向解析结果（包括解析不到的None）
+known_ip_cache = TTLCache(CACHE_SIZE, KNOWN_IP_TTL)
+ptr_cache = TTLCache(CACHE_SIZE, PTR_TTL)
+_mmdb_readers = None
+
+def get_mmdb_readers():
+    """mmdb文件只在容器首次调用时以MODE_MMAP打开，之后复用"""
+    global _mmdb_readers
+    if _mmdb_readers is None:
+        _mmdb_readers = (maxminddb.open_database(MMDB_ASN, maxminddb.MODE_MMAP),
+                         maxminddb.open_database(MMDB_COUNTRY, maxminddb.MODE_MMAP))
+    return _mmdb_readers
+
+resolver = dns.resolver.Resolver()
+resolver.timeout = 1
+resolver.lifetime = 1
 
 def reverse_dns_lookup(ip_address):
     try:
         addr = dns.reversename.from_address(ip_address)
-        resolver = dns.resolver.Resolver()
-        resolver.timeout = 1
-        resolver.lifetime = 1
         answers = resolver.resolve(addr, "PTR")
         return (ip_address, str(answers[0]).rstrip('.'))
     except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.Timeout, dns.exception.DNSException):
         return (ip_address, None)
 
 def batch_reverse_lookup(ip_list, max_workers=20):
+    """反向解析，缓存中已有的ip直接返回，只解析未缓存的ip"""
     results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_ip = {executor.submit(reverse_dns_lookup, ip): ip for ip in ip_list}
-        for future in concurrent.futures.as_completed(future_to_ip):
-            ip, hostname = future.result()
+    pending = []
+    for ip in ip_list:
+        hostname = ptr_cache.get(ip)
+        if hostname is TTLCache.MISSING:
+            pending.append(ip)
+        else:
             results[ip] = hostname
+    if pending:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_ip = {executor.submit(reverse_dns_lookup, ip): ip for ip in pending}
+            for future in concurrent.futures.as_completed(future_to_ip):
+                ip, hostname = future.result()
+                results[ip] = hostname
+                ptr_cache.set(ip, hostname)
+    print(f"反向解析{len(ip_list)}个ip，缓存命中{len(ip_list) - len(pending)}个")
     return results
 
 def simplify_domains(domain):
@@ -71,94 +162,117 @@ def simplify_domains(domain):
     else:
         return domain
 
+def batch_get_actions(batch_ips):
+    """
+    查询一批（最多100个）ip，只取 ip 和 action 字段（action 是保留字，需要用 ExpressionAttributeNames）
+    UnprocessedKeys 按指数退避重试
+    返回:
+        ({ip: action}, 重试后仍未处理的ip列表)
+    """
+    request = {
+        table_name: {
+            'Keys': [{'ip': {'S': ip}} for ip in batch_ips],
+            'ProjectionExpression': '#ip, #action',
+            'ExpressionAttributeNames': {'#ip': 'ip', '#action': 'action'}
+        }
+    }
+    actions = {}
+    for attempt in range(DDB_MAX_RETRIES):
+        response = ddb_client.batch_get_item(RequestItems=request)
+        for item in response.get('Responses', {}).get(table_name, []):
+            actions[item['ip']['S']] = item.get('action', {}).get('S', '')
+        request = response.get('UnprocessedKeys') or {}
+        if not request:
+            return actions, []
+        time.sleep(min(0.05 * 2 ** attempt, 1) * (1 + random.random()))
+    return actions, [key['ip']['S'] for key in request[table_name]['Keys']]
+
 def batch_findip_in_ddb(ip_list):
-    existing_ips = []
-    non_existing_ips = []
+    """
+    返回ddb中没有记录（或未标记为slient-）的ip集合
+    每批100个ip并发查询，返回的项目按ip建成字典后逐个查找；
+    重试后仍未查询到结果的ip也作为候选返回，由后续的条件写入去重（已静默的ip写入失败，不会通知），
+    避免限流时漏掉新ip
+    """
+    new_ips = set()
+    unresolved = []
     
-    table = ddb_resource.Table(table_name)
+    # 缓存中已确认静默的ip不再查询
+    pending = [ip for ip in ip_list if not known_ip_cache.get(ip, False)]
+    print(f"查询{len(ip_list)}个ip，已知ip缓存命中{len(ip_list) - len(pending)}个")
     
     # 每批最多 100 个项目（batch_get_item 限制）
     batch_size = 100
-    for i in range(0, len(ip_list), batch_size):
-        batch_ips = ip_list[i:i+batch_size]
-        
-        try:
-            response = ddb_resource.batch_get_item(
-                RequestItems={
-                    table_name: {
-                        'Keys': [{'ip': ip} for ip in batch_ips]
-                    }
-                }
-            )
-            
-            # 获取返回的项目
-            returned_items = response.get('Responses', {}).get(table_name, [])
-            returned_ips = {item['ip'] for item in returned_items}
-            
+    batches = [pending[i:i+batch_size] for i in range(0, len(pending), batch_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DDB_WORKERS) as executor:
+        future_to_batch = {executor.submit(batch_get_actions, batch_ips): batch_ips for batch_ips in batches}
+        for future in concurrent.futures.as_completed(future_to_batch):
+            batch_ips = future_to_batch[future]
+            try:
+                actions, failed = future.result()
+            except ClientError as e:
+                print(f"Error executing batch_get_item: {e}")
+                unresolved.extend(batch_ips)
+                new_ips.update(batch_ips)
+                continue
+            unresolved.extend(failed)
+            failed = set(failed)
             for ip in batch_ips:
-                if ip in returned_ips:
-                    # 找到对应的项目并检查action
-                    item = next(item for item in returned_items if item['ip'] == ip)
-                    action = item.get('action', '')
-                    if action.startswith('slient-'):
-                        existing_ips.append(ip)
-                    else:
-                        non_existing_ips.append(ip)
+                if ip in failed:
+                    new_ips.add(ip)
+                elif actions.get(ip, '').startswith('slient-'):
+                    known_ip_cache.set(ip, True)
                 else:
-                    non_existing_ips.append(ip)
-                    
-        except ClientError as e:
-            print(f"Error executing batch_get_item: {e}")
-            non_existing_ips.extend(batch_ips)
-            
-    return non_existing_ips
+                    new_ips.add(ip)
+    
+    if unresolved:
+        print(f"有{len(unresolved)}个ip查询DynamoDB失败，作为候选ip由条件写入去重")
+    return new_ips
 
 def fill_ip_data(rows):
     cnt = []
     ip_list = [item["dstaddr"] for item in rows]
     # 获得的ip为ddb没记录的
-    new_ip_list = batch_findip_in_ddb(ip_list)
-    print(f"找到{len(new_ip_list)}个新ip")
-    with maxminddb.open_database('data/GeoLite2-ASN.mmdb') as reader_asn:
-        with maxminddb.open_database('data/GeoLite2-Country.mmdb') as reader_country:
-            results = batch_reverse_lookup(new_ip_list)
-            for item in rows:
-                ip = item["dstaddr"]
-                if ip in new_ip_list:
-                    hostname = results[ip]
-                    hostname = simplify_domains(hostname)
-                    total_bytes = int(item["total_bytes"])
-                    connection_count = int(item["connection_count"])
-                    asn = reader_asn.get_with_prefix_len(ip)
-                    country = reader_country.get_with_prefix_len(ip)
-                    asn_no = 'ASN' + str(asn[0]['autonomous_system_number'])
-                    asn_name = asn[0]['autonomous_system_organization']
-                    asn_prefix = asn[1]
-                    country_code = country[0]['country']['iso_code'] if 'country' in country[0] else country[0]['registered_country']['iso_code']
-                    # print(ip, hostname, asn_no, asn_name, asn_prefix, country_code)
-                    cnt.append({
-                        "ip": ip,
-                        "host": hostname,
-                        "bytes": total_bytes,
-                        "connection": connection_count,
-                        "asn": asn_no,
-                        "asn_name": asn_name,
-                        "asn_prefix": asn_prefix,
-                        "country_code": country_code})
+    new_ips = batch_findip_in_ddb(ip_list)
+    print(f"找到{len(new_ips)}个新ip")
+    new_rows = [item for item in rows if item["dstaddr"] in new_ips]
+    reader_asn, reader_country = get_mmdb_readers()
+    results = batch_reverse_lookup(list(new_ips))
+    for item in new_rows:
+        ip = item["dstaddr"]
+        hostname = results[ip]
+        hostname = simplify_domains(hostname)
+        total_bytes = int(item["total_bytes"])
+        connection_count = int(item["connection_count"])
+        asn = reader_asn.get_with_prefix_len(ip)
+        country = reader_country.get_with_prefix_len(ip)
+        asn_no = 'ASN' + str(asn[0]['autonomous_system_number'])
+        asn_name = asn[0]['autonomous_system_organization']
+        asn_prefix = asn[1]
+        country_code = country[0]['country']['iso_code'] if 'country' in country[0] else country[0]['registered_country']['iso_code']
+        # print(ip, hostname, asn_no, asn_name, asn_prefix, country_code)
+        cnt.append({
+            "ip": ip,
+            "host": hostname,
+            "bytes": total_bytes,
+            "connection": connection_count,
+            "asn": asn_no,
+            "asn_name": asn_name,
+            "asn_prefix": asn_prefix,
+            "country_code": country_code})
     return cnt
 
 def write_ip_with_put_item(ip, attributes):
     """
-    使用PutItem将单个IP地址及其属性写入DynamoDB表
+    使用条件PutItem将单个IP地址及其属性写入DynamoDB表
+    只有ip不存在、或未标记为slient-时才写入，多个并发运行时同一个ip只会有一个写入成功
     
     参数:
         ip (str): 要写入的IP地址
         attributes (dict): IP地址的属性       
     返回:
-        bool: 是否成功写入
+        str: 'written' 本次写入，'exists' 已被其他运行写入为slient-，'failed' 写入失败
     """
-    table = ddb_resource.Table(table_name)
-    
     # 准备项目数据
     item = {'ip': ip, 'action': 'slient-by-insert'}
     item['record_time'] = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
@@ -174,11 +288,42 @@ def write_ip_with_put_item(ip, attributes):
                 item[key] = value
     try:
         # 写入项目
-        response = table.put_item(Item=item)
-        return True
+        ddb_client.put_item(
+            TableName=table_name,
+            Item={key: ddb_serializer.serialize(value) for key, value in item.items()},
+            ConditionExpression='attribute_not_exists(#ip) OR NOT begins_with(#action, :silent)',
+            ExpressionAttributeNames={'#ip': 'ip', '#action': 'action'},
+            ExpressionAttributeValues={':silent': {'S': 'slient-'}}
+        )
+        known_ip_cache.set(ip, True)
+        return 'written'
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            # 已被其他运行写入为slient-
+            known_ip_cache.set(ip, True)
+            return 'exists'
         print(f"Error writing IP {ip}: {e}")
-        return False
+        return 'failed'
+    except Exception as e:
+        print(f"Error writing IP {ip}: {e}")
+        return 'failed'
+
+def batch_write_new_ips(objs):
+    """
+    并发写入新ip（BatchWriteItem 不支持条件写入，这里用有界线程池并发执行条件PutItem）
+    返回:
+        list: 需要通知的记录：本次写入的，以及写入失败的（recorded=False，仍然通知，避免漏报）
+              只有已被其他运行写入的ip不再通知
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DDB_WORKERS) as executor:
+        results = list(executor.map(lambda obj: write_ip_with_put_item(obj['ip'], obj), objs))
+    notify = []
+    for obj, result in zip(objs, results):
+        if result == 'exists':
+            continue
+        obj['recorded'] = result == 'written'
+        notify.append(obj)
+    return notify
 
 def wait_for_query_completion(execution_id, max_wait_time=300):
     """
@@ -213,20 +358,56 @@ def wait_for_query_completion(execution_id, max_wait_time=300):
 
 def get_query_results(execution_id, max_results=1000):
     """
-    获取查询结果
+    按NextToken逐页获取查询结果，逐行返回
     
     参数:
         execution_id (str): 查询执行ID
-        max_results (int): 返回的最大结果行数
+        max_results (int): 每页的最大结果行数
     
     返回:
-        dict: 查询结果
+        generator: 每行为 {列名: 值} 的dict
     """
-    response = athena_client.get_query_results(
-        QueryExecutionId=execution_id,
-        MaxResults=max_results
-    )
-    return response
+    paginator = athena_client.get_paginator('get_query_results')
+    columns = None
+    for page in paginator.paginate(QueryExecutionId=execution_id,
+                                   PaginationConfig={'PageSize': max_results}):
+        rows = page['ResultSet']['Rows']
+        if columns is None:
+            columns = [col['Label'] for col in page['ResultSet']['ResultSetMetadata']['ColumnInfo']]
+            rows = rows[1:]  # 跳过标题行
+        for row in rows:
+            values = [field.get('VarCharValue', '') for field in row['Data']]
+            yield dict(zip(columns, values))
+
+def stream_query_results(execution_status):
+    """
+    从S3输出位置流式读取查询结果CSV，逐行返回，不把整个结果读入内存
+    读取S3失败时退回 get_query_results 分页读取
+    
+    参数:
+        execution_status (dict): get_query_execution 的返回
+    
+    返回:
+        generator: 每行为 {列名: 值} 的dict
+    """
+    execution = execution_status['QueryExecution']
+    location = urlparse(execution['ResultConfiguration']['OutputLocation'])
+    try:
+        body = s3_client.get_object(Bucket=location.netloc, Key=location.path.lstrip('/'))['Body']
+    except ClientError as e:
+        print(f"读取查询结果文件失败，改为分页读取: {e}")
+        yield from get_query_results(execution['QueryExecutionId'])
+        return
+    try:
+        yield from csv.DictReader(codecs.getreader('utf-8')(body))
+    finally:
+        body.close()
+
+def chunked(rows, size):
+    """把行迭代器切成最多size行的列表"""
+    iterator = iter(rows)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
 
 def start_query(data_base, workgroup, query_string):
     '''
@@ -255,69 +436,230 @@ def start_query(data_base, workgroup, query_string):
     response = athena_client.start_query_execution(**params)
     return response['QueryExecutionId']
 
+def partition_predicate(last_minute, now=None):
+    """
+    生成覆盖最近last_minute分钟的分区条件（flowlog按UTC小时分区，表使用分区投影）
+    
+    参数:
+        last_minute (int): 查询窗口分钟数
+        now (datetime): 窗口结束时间，默认当前UTC时间
+    
+    返回:
+        str: 形如 ((year = '2025' AND month = '10' AND day = '11' AND hour = '06') OR ...) 的条件
+    """
+    now = now or datetime.now(timezone.utc)
+    hour = (now - timedelta(minutes=last_minute)).replace(minute=0, second=0, microsecond=0)
+    conditions = []
+    while hour <= now:
+        conditions.append(f"(year = '{hour:%Y}' AND month = '{hour:%m}' AND day = '{hour:%d}' AND hour = '{hour:%H}')")
+        hour += timedelta(hours=1)
+    return '(' + ' OR '.join(conditions) + ')'
+
+def process_rows(rows):
+    """
+    按块处理汇总行，每块查询dynamodb、补充ip信息并写入新ip
+    
+    参数:
+        rows (iterable): 每行包含 dstaddr/total_bytes/connection_count 的dict
+    
+    返回:
+        tuple: (处理的行数, 本次实际写入的新ip记录)
+    """
+    total = 0
+    cnt = []
+    for chunk in chunked(rows, RESULT_CHUNK_SIZE):
+        total += len(chunk)
+        cnt.extend(batch_write_new_ips(fill_ip_data(chunk)))
+    return total, cnt
+
+def notify_new_ips(cnt):
+    email = ""
+    for obj in cnt:
+        if email == "":
+            email = "发现以下新IP：\nip/段 | 流量 | 链接数 | 域名 | 国家 | ASN | ASN名称\n"
+        email += f"{obj['ip']}/{obj['asn_prefix']} | {obj['bytes']} | {obj['connection']} | {obj['host']} | {obj['country_code']} | {obj['asn']} | {obj['asn_name']}"
+        email += " | 未记录（写入dynamodb失败）\n" if not obj.get('recorded', True) else "\n"
+    if email != "":
+        message_data = {
+            "default": json.dumps(cnt),
+            "email": email,
+        }
+        try:
+            response = sns_client.publish(
+                TopicArn=SNS_TOPIC_ARN,
+                Message=json.dumps(message_data),
+                MessageStructure='json',
+                Subject='NAT Gatway有对外访问的新IP！'
+            )
+            print(response)
+        except ClientError as e:
+            print(f"Error publish: {e}")
+
 def check_last_data(last_minute):
     query_string = f'''
     SELECT
         dstaddr, SUM(bytes) as total_bytes, COUNT(*) as connection_count,
         date_format(from_unixtime(MIN("start"), 'Asia/Shanghai'),'%Y-%m-%d %H:%i:%s') as s,
         date_format(from_unixtime(MAX("end"), 'Asia/Shanghai'),'%Y-%m-%d %H:%i:%s') as e
-    FROM vpc_flow_logs WHERE action = 'ACCEPT'
+    FROM vpc_flow_logs WHERE {partition_predicate(last_minute)}
+        AND action = 'ACCEPT'
         AND not regexp_like(dstaddr, '^(10\\.|172\\.(1[6-9]|2[0-9]|3[01])\\.|192\\.168\\.|127\\.|169\\.254\\.)')
         AND start >= CAST(to_unixtime(DATE_ADD('minute', -{last_minute}, CURRENT_TIMESTAMP)) AS BIGINT)
     GROUP BY dstaddr ORDER BY total_bytes DESC;
     '''
 
-    wait_for_query_completion(start_query(athena_db, athena_workgroup, 'MSCK REPAIR TABLE `vpc_flow_logs`;'))
-
     execution_id = start_query(athena_db, athena_workgroup, query_string)
 
     execution_status = wait_for_query_completion(execution_id)
     if execution_status and execution_status['QueryExecution']['Status']['State'] == 'SUCCEEDED':
-        results = get_query_results(execution_id)
-
-        # 处理结果
-        columns = [col['Label'] for col in results['ResultSet']['ResultSetMetadata']['ColumnInfo']]
-        print("查询结果列: ", columns)
-        
-        rows = []
-        for row in results['ResultSet']['Rows'][1:]:  # 跳过标题行
-            values = [field.get('VarCharValue', '') for field in row['Data']]
-            rows.append(dict(zip(columns, values)))
-        
-        print(f"查询返回了 {len(rows)} 行数据")
-        # print(json.dumps(rows[:5], indent=2))  # 打印前5行数据
-
-        cnt = fill_ip_data(rows)
-        email = ""
-        for obj in cnt:
-            write_ip_with_put_item(obj['ip'], obj)
-            if email == "":
-                email = "发现以下新IP：\nip/段 | 流量 | 链接数 | 域名 | 国家 | ASN | ASN名称\n"
-            email += f"{obj['ip']}/{obj['asn_prefix']} | {obj['bytes']} | {obj['connection']} | {obj['host']} | {obj['country_code']} | {obj['asn']} | {obj['asn_name']}\n"
-        if email != "":
-            message_data = {
-                "default": json.dumps(cnt),
-                "email": email,
-            }
-            try:
-                response = sns_client.publish(
-                    TopicArn=SNS_TOPIC_ARN,
-                    Message=json.dumps(message_data),
-                    MessageStructure='json',
-                    Subject='NAT Gatway有对外访问的新IP！'
-                )
-                print(response)
-            except ClientError as e:
-                print(f"Error publish: {e}")
+        total, cnt = process_rows(stream_query_results(execution_status))
+        print(f"查询返回了 {total} 行数据")
+        notify_new_ips(cnt)
     else:
         print("查询执行失败或被取消")
 
+class FlowWindow:
+    """
+    按dstaddr汇总流量的滑动窗口，记录按flowlog的start时间分钟分桶，
+    窗口按已读到的最大end时间向前滑动，不依赖Lambda的执行时间，本地回放日志时结果一致
+    放在模块级别，Lambda容器复用时跨调用保留
+    """
+    def __init__(self, minutes):
+        self.seconds = minutes * 60
+        self.buckets = {}  # 分钟 -> {dstaddr: [bytes, 记录数, 最早start, 最晚end]}
+        self.latest = 0
+
+    def add(self, dst, nbytes, start, end):
+        minute = start // 60
+        if (minute + 1) * 60 <= self.latest - self.seconds:
+            return
+        bucket = self.buckets.get(minute)
+        if bucket is None:
+            bucket = self.buckets[minute] = {}
+        stat = bucket.get(dst)
+        if stat is None:
+            bucket[dst] = [nbytes, 1, start, end]
+        else:
+            stat[0] += nbytes
+            stat[1] += 1
+            if start < stat[2]:
+                stat[2] = start
+            if end > stat[3]:
+                stat[3] = end
+        if end > self.latest:
+            self.latest = end
+
+    def expire(self):
+        cutoff = (self.latest - self.seconds) // 60
+        for minute in [minute for minute in self.buckets if minute < cutoff]:
+            del self.buckets[minute]
+
+    def rows(self, dsts):
+        """返回dsts在窗口内的汇总，格式与Athena查询结果相同，按流量降序"""
+        totals = {}
+        for bucket in self.buckets.values():
+            for dst in dsts:
+                stat = bucket.get(dst)
+                if stat is None:
+                    continue
+                total = totals.get(dst)
+                if total is None:
+                    totals[dst] = list(stat)
+                else:
+                    total[0] += stat[0]
+                    total[1] += stat[1]
+                    total[2] = min(total[2], stat[2])
+                    total[3] = max(total[3], stat[3])
+        return [{
+            'dstaddr': dst.decode(),
+            'total_bytes': str(total[0]),
+            'connection_count': str(total[1]),
+            's': datetime.fromtimestamp(total[2], SHANGHAI).strftime('%Y-%m-%d %H:%M:%S'),
+            'e': datetime.fromtimestamp(total[3], SHANGHAI).strftime('%Y-%m-%d %H:%M:%S'),
+        } for dst, total in sorted(totals.items(), key=lambda item: item[1][0], reverse=True)]
+
+flow_window = FlowWindow(STREAM_WINDOW_MINUTES)
+
+def parse_flow_log(lines):
+    """
+    解析文本格式的flowlog行（bytes），只切分需要的字段，dstaddr保持bytes不解码
+    跳过标题行、NODATA/SKIPDATA记录、非ACCEPT和内网目标地址
+    
+    返回:
+        generator: (dstaddr, bytes, start, end)
+    """
+    for line in lines:
+        fields = line.split(None, FLOW_ACTION + 1)
+        if len(fields) <= FLOW_ACTION or fields[FLOW_ACTION] != b'ACCEPT':
+            continue
+        dst = fields[FLOW_DSTADDR]
+        if PRIVATE_DST.match(dst):
+            continue
+        yield dst, int(fields[FLOW_BYTES]), int(fields[FLOW_START]), int(fields[FLOW_END])
+
+def read_flow_log(fileobj):
+    """
+    流式解压一个gzip flowlog文件，记录加入滑动窗口
+    
+    返回:
+        set: 文件中出现的dstaddr
+    """
+    dsts = set()
+    with gzip.GzipFile(fileobj=fileobj) as lines:
+        for dst, nbytes, start, end in parse_flow_log(lines):
+            flow_window.add(dst, nbytes, start, end)
+            dsts.add(dst)
+    return dsts
+
+def detect_window(dsts):
+    """对本次出现的dstaddr按窗口汇总后执行与Athena路径相同的新ip判断和通知"""
+    flow_window.expire()
+    total, cnt = process_rows(flow_window.rows(dsts))
+    print(f"滑动窗口内汇总了 {total} 个目标ip")
+    notify_new_ips(cnt)
+
+def process_s3_event(records):
+    """处理S3 ObjectCreated事件，逐个读取新写入的flowlog文件"""
+    dsts = set()
+    for record in records:
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        print(f"读取flowlog: s3://{bucket}/{key}")
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        try:
+            dsts |= read_flow_log(body)
+        finally:
+            body.close()
+    detect_window(dsts)
+
 def lambda_handler(event, context):
-    check_last_data(REFRESH_INTERVAL+5)
+    records = (event or {}).get('Records')
+    if records and 's3' in records[0]:
+        # flowlog文件写入S3时触发的实时检测
+        process_s3_event(records)
+    else:
+        # EventBridge定时触发的Athena汇总查询
+        check_last_data(REFRESH_INTERVAL+5)
     return {
         'statusCode': 200,
         'body': 'finish'
     }
 
 if __name__ == "__main__":
-    lambda_handler(null, null)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='NAT Gateway流量分析，不指定文件时执行Athena查询')
+    parser.add_argument('files', nargs='*', help='本地gzip文本格式flowlog文件，按实时检测路径处理')
+    parser.add_argument('--dry-run', action='store_true', help='只解析和汇总本地文件并打印，不访问dynamodb和SNS')
+    args = parser.parse_args()
+    if not args.files:
+        lambda_handler({}, None)
+    else:
+        dsts = set()
+        for path in args.files:
+            with open(path, 'rb') as f:
+                dsts |= read_flow_log(f)
+        if args.dry_run:
+            flow_window.expire()
+            for row in flow_window.rows(dsts):
+                print(row['dstaddr'], row['total_bytes'], row['connection_count'], row['s'], row['e'])
+        else:
+            detect_window(dsts)